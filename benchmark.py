@@ -0,0 +1,404 @@
+"""
+Times each stage of loading a page: fetching the document and its
+stylesheets, HTML parsing, CSS parsing, styling, layout and painting.
+Scripts are not run, so that the numbers only cover our own code.
+
+    python3 benchmark.py record ARCHIVE URL... [--headless]
+    python3 benchmark.py replay ARCHIVE URL... [--latency S] [--bandwidth B]
+                                               [--loopback] [--headless]
+                                               [--repeat N]
+    python3 benchmark.py parse FILE... [--repeat N]
+    python3 benchmark.py synthetic [--repeat N]
+    python3 benchmark.py style [--rules N] [--repeat N]
+    python3 benchmark.py css [FILE...] [--repeat N]
+
+Recording fetches from the live network and saves every response to
+ARCHIVE; replaying serves the same bytes from it, so runs on different
+commits, or on a machine without network, can be compared directly.
+With --headless, text is measured from built-in tables instead of Tk, so
+layout needs no display and its timings don't include Tcl round trips.
+The parse mode times HTMLParser alone on local files, and the synthetic
+mode on generated documents of growing size, very deep, very wide and full
+of attributes, to show how parse time scales. The style mode times style() on a generated
+page against a generated stylesheet with many rules. The css mode times
+CSSParser on stylesheet files, or on a generated minified one full of the
+at-rules, comments and selectors it has to skip.
+"""
+
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import transport
+from cache import CACHE
+from fontbackend import HeadlessFontBackend
+from htmlparser import HTMLParser, Element
+from layout import DocumentLayout
+from style import CSSParser, StyleSheet, Cascade, style, cascade_priority
+from url import URL
+from utils import tree_to_list, iter_tree, paint_tree, font_cache_stats, \
+    use_font_backend
+
+STAGES = ["fetch", "parse", "css", "style", "layout", "paint"]
+
+
+def load_page(url):
+    """ mirrors Tab.load and Tab.render, returning seconds per stage """
+    times = {}
+    start = time.perf_counter()
+    body = url.request()
+    times["fetch"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    nodes = HTMLParser(body).parse()
+    times["parse"] = time.perf_counter() - start
+
+    links = [node.attributes["href"]
+             for node in iter_tree(nodes)
+             if isinstance(node, Element)
+             and node.tag == "link"
+             and node.attributes.get("rel") == "stylesheet"
+             and "href" in node.attributes]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = 8) as pool:
+        futures = [pool.submit(lambda link: url.resolve(link).request(), link)
+                   for link in links]
+        sheets = []
+        for future in futures:
+            try:
+                sheets.append(future.result())
+            except Exception:
+                pass
+    times["fetch"] += time.perf_counter() - start
+
+    # compiled afresh rather than taken from STYLESHEETS, as on a first visit
+    start = time.perf_counter()
+    cascade = Cascade([StyleSheet(open("browser.css").read())] +
+                      [StyleSheet(sheet) for sheet in sheets])
+    times["css"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    style(nodes, cascade.index)
+    times["style"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    document = DocumentLayout(nodes)
+    document.layout()
+    times["layout"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    display_list = []
+    paint_tree(document, display_list)
+    times["paint"] = time.perf_counter() - start
+    return times
+
+
+def create_font_root():
+    """ Tk fonts can only be measured once a Tk root exists """
+    import tkinter
+    root = tkinter.Tk()
+    root.withdraw()
+
+
+def run(urls, repeat, layout):
+    results = {}
+    for url in urls:
+        samples = []
+        for i in range(repeat):
+            # every run starts cold, as on a first visit, and is served the
+            # same responses as the first
+            CACHE.clear()
+            transport.current().rewind()
+            if layout:
+                samples.append(load_page(URL(url)))
+            else:
+                samples.append({"fetch": fetch_only(URL(url))})
+        results[url] = {stage: statistics.median(
+                            [sample[stage] for sample in samples])
+                        for stage in samples[0]}
+    return results
+
+
+def fetch_only(url):
+    start = time.perf_counter()
+    url.request()
+    return time.perf_counter() - start
+
+
+def report(results, as_json):
+    if as_json:
+        print(json.dumps(results, indent = 2))
+        return
+    for url, times in results.items():
+        print(url)
+        for stage in STAGES:
+            if stage in times:
+                print("  {:8} {:10.2f} ms".format(stage, times[stage] * 1000))
+        print("  {:8} {:10.2f} ms".format("total",
+                                            sum(times.values()) * 1000))
+
+
+def parse_files(paths, repeat, as_json):
+    results = {}
+    for path in paths:
+        with open(path, encoding = "utf8", errors = "replace") as f:
+            body = f.read()
+        samples = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            HTMLParser(body).parse()
+            samples.append(time.perf_counter() - start)
+        seconds = statistics.median(samples)
+        results[path] = {"seconds": seconds,
+                         "mb_per_s": len(body) / seconds / 1e6}
+    if as_json:
+        print(json.dumps(results, indent = 2))
+        return
+    for path, result in results.items():
+        print("{}: {:.2f} ms, {:.2f} MB/s".format(
+            path, result["seconds"] * 1000, result["mb_per_s"]))
+
+
+def deep_document(n):
+    return "<html><body>" + "<div>x" * n + "</div>" * n + "</body></html>"
+
+def wide_document(n):
+    return "<html><body>" + "<p>x <b>y</b></p>" * n + "</body></html>"
+
+def attribute_document(n):
+    # mostly markup, like a page of navigation, cards and links
+    return "<html><body>" + "".join(
+        '<div class="item c{}"><a href="/p/{}?q={}">link</a></div>\n'.format(
+            i % 7, i, i) for i in range(n)) + "</body></html>"
+
+SYNTHETIC = {"deep": deep_document, "wide": wide_document,
+             "attributes": attribute_document}
+SYNTHETIC_SIZES = [1000, 10000, 100000]
+
+
+def parse_synthetic(repeat, as_json):
+    results = {}
+    for shape, generate in SYNTHETIC.items():
+        for n in SYNTHETIC_SIZES:
+            body = generate(n)
+            samples = []
+            for i in range(repeat):
+                start = time.perf_counter()
+                HTMLParser(body).parse()
+                samples.append(time.perf_counter() - start)
+            seconds = statistics.median(samples)
+            results[shape + " " + str(n)] = {
+                "seconds": seconds, "us_per_element": seconds / n * 1e6}
+    if as_json:
+        print(json.dumps(results, indent = 2))
+        return
+    # linear scaling shows up as a flat time per element
+    for name, result in results.items():
+        print("{:17} {:10.2f} ms {:8.2f} us/element".format(
+            name, result["seconds"] * 1000, result["us_per_element"]))
+
+
+STYLE_TAGS = ["div", "p", "span", "a", "b", "i", "ul", "li", "table", "tr",
+              "td", "h1", "h2", "h3", "section", "article", "nav", "header",
+              "footer", "em", "strong", "small", "code", "pre", "label"]
+STYLE_PROPERTIES = ["color", "background-color", "font-size", "font-weight"]
+
+
+def style_page(n):
+    """ n list items of nested tags drawn from STYLE_TAGS """
+    rng = random.Random(0)
+    items = []
+    for i in range(n):
+        tags = rng.sample(STYLE_TAGS, 3)
+        items.append("".join("<" + tag + ">" for tag in tags) + "text" +
+                     "".join("</" + tag + ">" for tag in reversed(tags)))
+    return "<html><body><div>" + "".join(items) + "</div></body></html>"
+
+
+def style_sheet(n):
+    """ n rules of one to three tags, like a large site stylesheet """
+    rng = random.Random(1)
+    rules = []
+    for i in range(n):
+        selector = " ".join(rng.choice(STYLE_TAGS)
+                            for j in range(rng.randint(1, 3)))
+        rules.append(selector + " { " + rng.choice(STYLE_PROPERTIES) +
+                     ": " + str(rng.randint(1, 99)) + "px; }")
+    return "\n".join(rules)
+
+
+def time_style(rules, repeat, as_json):
+    nodes = HTMLParser(style_page(2000)).parse()
+    count = len(tree_to_list(nodes, []))
+    results = {}
+    for n in [100, 1000, rules]:
+        sheet = sorted(CSSParser(style_sheet(n)).parse(),
+                       key = cascade_priority)
+        samples = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            style(nodes, sheet)
+            samples.append(time.perf_counter() - start)
+        results[str(n) + " rules"] = {"seconds": statistics.median(samples),
+                                      "nodes": count}
+    if as_json:
+        print(json.dumps(results, indent = 2))
+        return
+    for name, result in results.items():
+        print("{:12} {:10.2f} ms for {} nodes".format(
+            name, result["seconds"] * 1000, result["nodes"]))
+
+
+def minified_sheet(n):
+    """ n rules written the way minifiers and frameworks write them """
+    rng = random.Random(2)
+    rules = []
+    for i in range(n):
+        tags = rng.sample(STYLE_TAGS, rng.randint(1, 3))
+        kind = rng.randint(0, 9)
+        if kind == 0:
+            selector = ">".join(tags)
+        elif kind == 1:
+            selector = ",".join(tags)
+        elif kind == 2:
+            selector = tags[0] + ":hover"
+        else:
+            selector = " ".join(tags)
+        declarations = []
+        for j in range(rng.randint(1, 4)):
+            value = rng.choice(["12px", "#fff", "bold", "0", "100%",
+                                "rgb(0,0,0)", "1px solid #ccc",
+                                "red!important"])
+            declarations.append(rng.choice(STYLE_PROPERTIES) + ":" + value)
+        rule = selector + "{" + ";".join(declarations) + "}"
+        if kind == 3:
+            rule = "@media (max-width:600px){" + rule + "}"
+        elif kind == 4:
+            rule = "/*" + tags[0] + "*/" + rule
+        rules.append(rule)
+    return "".join(rules)
+
+
+def time_css(paths, repeat, as_json):
+    sheets = {}
+    for path in paths:
+        with open(path, encoding = "utf8", errors = "replace") as f:
+            sheets[path] = f.read()
+    if not paths:
+        sheets["minified 50000"] = minified_sheet(50000)
+    results = {}
+    for name, text in sheets.items():
+        samples = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            rules = CSSParser(text).parse()
+            samples.append(time.perf_counter() - start)
+        seconds = statistics.median(samples)
+        results[name] = {"seconds": seconds,
+                         "mb_per_s": len(text) / seconds / 1e6,
+                         "rules_per_s": len(rules) / seconds,
+                         "rules": len(rules)}
+    if as_json:
+        print(json.dumps(results, indent = 2))
+        return
+    for name, result in results.items():
+        print("{}: {:.2f} ms, {:.2f} MB/s, {:.0f} rules/s ({} rules)".format(
+            name, result["seconds"] * 1000, result["mb_per_s"],
+            result["rules_per_s"], result["rules"]))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = __doc__.split("\n")[1])
+    modes = parser.add_subparsers(dest = "mode", required = True)
+
+    record = modes.add_parser("record", help = "load URLs from the network")
+    replay = modes.add_parser("replay", help = "load URLs from an archive")
+    for mode in [record, replay]:
+        mode.add_argument("archive")
+        mode.add_argument("urls", nargs = "+")
+        mode.add_argument("--no-layout", action = "store_true",
+                          help = "only time fetching, no Tk needed")
+        mode.add_argument("--headless", action = "store_true",
+                          help = "measure text without Tk, see fontbackend")
+    replay.add_argument("--latency", type = float, default = 0,
+                        help = "seconds added before every response")
+    replay.add_argument("--bandwidth", type = float, default = None,
+                        help = "bytes per second for response bodies")
+    replay.add_argument("--recorded-timing", action = "store_true",
+                        help = "delay responses as long as when recorded")
+    replay.add_argument("--loopback", action = "store_true",
+                        help = "replay through a local HTTP server")
+
+    parse = modes.add_parser("parse", help = "time HTMLParser on files")
+    parse.add_argument("files", nargs = "+")
+    synthetic = modes.add_parser("synthetic",
+                                 help = "time HTMLParser on generated pages")
+    styles = modes.add_parser("style",
+                              help = "time style() on a large stylesheet")
+    styles.add_argument("--rules", type = int, default = 5000)
+    css = modes.add_parser("css", help = "time CSSParser on stylesheets")
+    css.add_argument("files", nargs = "*")
+
+    for mode in [replay, parse, synthetic, styles, css]:
+        mode.add_argument("--repeat", type = int, default = 5)
+        mode.add_argument("--json", action = "store_true")
+    args = parser.parse_args(argv)
+
+    if args.mode == "parse":
+        parse_files(args.files, args.repeat, args.json)
+        return
+    if args.mode == "synthetic":
+        parse_synthetic(args.repeat, args.json)
+        return
+    if args.mode == "style":
+        time_style(args.rules, args.repeat, args.json)
+        return
+    if args.mode == "css":
+        time_css(args.files, args.repeat, args.json)
+        return
+
+    # the benchmark has to see every request, not the browser's disk cache
+    CACHE.disk = None
+    layout = not args.no_layout
+    if layout and args.headless:
+        use_font_backend(HeadlessFontBackend())
+    elif layout:
+        create_font_root()
+
+    if args.mode == "record":
+        recorder = transport.RecordingTransport(args.archive)
+        transport.use(recorder)
+        for url in args.urls:
+            if layout:
+                load_page(URL(url))
+            else:
+                fetch_only(URL(url))
+        recorder.save()
+        print("recorded", len(recorder.records), "responses to",
+              args.archive)
+        return
+
+    server = None
+    if args.loopback:
+        server = transport.ReplayServer(args.archive, args.latency,
+                                        args.bandwidth, args.recorded_timing)
+        transport.use(transport.LoopbackTransport(server))
+    else:
+        transport.use(transport.ReplayTransport(
+            args.archive, args.latency, args.bandwidth, args.recorded_timing))
+    try:
+        report(run(args.urls, args.repeat, layout), args.json)
+    finally:
+        if server: server.close()
+    if layout and not args.json:
+        stats = font_cache_stats()
+        print("font cache: {:.1%} of {} measurements were hits".format(
+            stats["hit_rate"], stats["hits"] + stats["misses"]))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,6 +4,7 @@ from chrome import Chrome
 from utils import *
 from draw import *
 from url import URL
+from connection import POOL
 from layout import *
 from tab import Tab
 
@@ -40,12 +41,28 @@ class Browser:
             cmd.execute(0, self.canvas)
         
     def new_tab(self, url):
-        new_tab = Tab(HEIGHT - self.chrome.bottom)
-        new_tab.load(url)
+        new_tab = Tab(HEIGHT - self.chrome.bottom, self.draw_partial,
+                      self.schedule)
+        # active before loading, so the page shows while it downloads
         self.active_tab = new_tab
         self.tabs.append(new_tab)
+        new_tab.load(url)
         self.draw()
         
+    def draw_partial(self, tab):
+        if tab != self.active_tab: return
+        self.draw()
+        # the event loop is blocked until the load finishes, so Tk has to be
+        # told to put the new frame on screen now
+        self.window.update_idletasks()
+        
+    def schedule(self, callback):
+        """ after_idle would be simpler, but update_idletasks in
+        draw_partial runs idle callbacks, including any they schedule, so
+        background layout would all happen at once there; a timer waits its
+        turn in the event loop """
+        self.window.after(0, callback)
+        
     def handle_down(self, e):
         self.active_tab.scrolldown()
         self.draw()
@@ -94,4 +111,6 @@ if __name__ == "__main__":
         for evt in pendingEvents():
             handleEvent(evt)
         drawScreen()
-    """
\ No newline at end of file
+    """
+    # say goodbye to servers rather than leaving them to time the sockets out
+    POOL.close_all()
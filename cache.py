@@ -0,0 +1,308 @@
+import email.utils
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+MEMORY_CACHE_BYTES = 32 * 1024 * 1024
+DISK_CACHE_BYTES = 256 * 1024 * 1024
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "web-browser")
+# statuses we know how to replay from the cache
+CACHEABLE_STATUSES = ["200", "203"]
+
+
+class CacheEntry:
+    def __init__(self, body, etag, last_modified, expires, fetch_time):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        # wall-clock time, so that entries stay meaningful across restarts
+        self.expires = expires
+        # how long the network took to deliver this body
+        self.fetch_time = fetch_time
+        self.size = len(body.encode("utf8"))
+
+    def is_fresh(self):
+        return time.time() < self.expires
+
+    def validators(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def to_json(self):
+        return json.dumps({
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "expires": self.expires,
+            "fetch_time": self.fetch_time,
+        })
+
+
+class MemoryCache:
+    """ least-recently-used entries are evicted once the bodies held add up
+    to more than max_bytes """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self.remove(key)
+        if entry.size > self.max_bytes: return
+        self.entries[key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last = False)
+            self.size -= evicted.size
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= entry.size
+
+
+class DiskCache:
+    """
+    One file per URL, named by a hash of the URL: a line of JSON metadata
+    followed by the body. Files are evicted oldest-written first once the
+    directory grows past max_bytes. Disk errors only ever cost us the cached
+    copy, never the page load.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.sizes = None
+
+    def path(self, key):
+        name = hashlib.sha256(key.encode("utf8")).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def scan(self):
+        if self.sizes is not None: return
+        self.sizes = {}
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        paths = [os.path.join(self.directory, name) for name in names]
+        for path in sorted(paths, key = os.path.getmtime):
+            self.sizes[path] = os.path.getsize(path)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), encoding = "utf8", newline = "") as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        return CacheEntry(body, meta["etag"], meta["last_modified"],
+                          meta["expires"], meta["fetch_time"])
+
+    def put(self, key, entry):
+        self.scan()
+        path = self.path(key)
+        try:
+            os.makedirs(self.directory, exist_ok = True)
+            with open(path, "w", encoding = "utf8", newline = "") as f:
+                f.write(entry.to_json() + "\n")
+                f.write(entry.body)
+        except OSError:
+            return
+        self.sizes.pop(path, None)
+        self.sizes[path] = entry.size
+        while sum(self.sizes.values()) > self.max_bytes:
+            oldest = next(iter(self.sizes))
+            del self.sizes[oldest]
+            try:
+                os.remove(oldest)
+            except OSError:
+                pass
+
+    def remove(self, key):
+        self.scan()
+        self.remove_path(self.path(key))
+
+    def remove_path(self, path):
+        self.sizes.pop(path, None)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class HTTPCache:
+    def __init__(self, memory_bytes = MEMORY_CACHE_BYTES,
+                 disk_bytes = DISK_CACHE_BYTES, directory = CACHE_DIR):
+        self.memory = MemoryCache(memory_bytes)
+        self.disk = DiskCache(directory, disk_bytes) if directory else None
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        # network time and bytes we would have spent without the cache
+        self.time_saved = 0.0
+        self.bytes_saved = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.memory.get(key)
+            if not entry and self.disk:
+                entry = self.disk.get(key)
+                if entry:
+                    self.memory.put(key, entry)
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.memory.put(key, entry)
+            if self.disk:
+                self.disk.put(key, entry)
+
+    def remove(self, key):
+        with self.lock:
+            self.memory.remove(key)
+            if self.disk:
+                self.disk.remove(key)
+
+    def clear(self, disk = False):
+        with self.lock:
+            self.memory = MemoryCache(self.memory.max_bytes)
+            if disk and self.disk:
+                self.disk.scan()
+                for path in list(self.disk.sizes):
+                    self.disk.remove_path(path)
+
+    def request(self, key, fetch):
+        """
+        Returns the body for key, calling fetch(headers) -> (status, headers,
+        body) only when there is no fresh copy. A stale copy with an ETag or
+        Last-Modified date is revalidated with a conditional request, and a
+        304 Not Modified answer counts as a hit.
+        """
+        entry = self.get(key)
+        if entry and entry.is_fresh():
+            with self.lock:
+                self.hits += 1
+                self.time_saved += entry.fetch_time
+                self.bytes_saved += entry.size
+            return entry.body
+
+        start = time.monotonic()
+        status, headers, body = fetch(entry.validators() if entry else {})
+        elapsed = time.monotonic() - start
+
+        if status == "304" and entry:
+            with self.lock:
+                self.revalidations += 1
+                self.time_saved += max(entry.fetch_time - elapsed, 0)
+                self.bytes_saved += entry.size
+            refreshed = make_entry(entry.body, headers, entry.fetch_time,
+                                   entry)
+            if refreshed:
+                self.put(key, refreshed)
+            return entry.body
+
+        with self.lock:
+            self.misses += 1
+        new_entry = None
+        if status in CACHEABLE_STATUSES:
+            new_entry = make_entry(body, headers, elapsed)
+        if new_entry:
+            self.put(key, new_entry)
+        elif entry:
+            self.remove(key)
+        return body
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.revalidations + self.misses
+            return {
+                "hits": self.hits,
+                "revalidations": self.revalidations,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.revalidations) / lookups
+                    if lookups else 0.0,
+                "time_saved": self.time_saved,
+                "bytes_saved": self.bytes_saved,
+                "memory_bytes": self.memory.size,
+            }
+
+
+def parse_cache_control(value):
+    directives = {}
+    for part in value.split(","):
+        part = part.strip()
+        if not part: continue
+        if "=" in part:
+            name, arg = part.split("=", 1)
+            directives[name.strip().casefold()] = arg.strip().strip('"')
+        else:
+            directives[part.casefold()] = ""
+    return directives
+
+def parse_http_date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def make_entry(body, headers, fetch_time, previous = None):
+    """
+    Builds the entry to store for a response, or returns None if it must not
+    be cached. previous is the entry being revalidated by a 304, whose
+    validators still apply unless the 304 carries new ones.
+    """
+    cache_control = parse_cache_control(headers.get("cache-control", ""))
+    if "no-store" in cache_control or headers.get("vary") == "*":
+        return None
+
+    etag = headers.get("etag", previous.etag if previous else None)
+    last_modified = headers.get("last-modified",
+                                previous.last_modified if previous else None)
+
+    now = time.time()
+    date = parse_http_date(headers.get("date", "")) or now
+    if "no-cache" in cache_control:
+        # may be stored, but must be revalidated before every use
+        lifetime = 0
+    elif "max-age" in cache_control:
+        try:
+            lifetime = int(cache_control["max-age"])
+        except ValueError:
+            lifetime = 0
+    elif "expires" in headers:
+        expires = parse_http_date(headers["expires"])
+        lifetime = expires - date if expires else 0
+    elif last_modified and parse_http_date(last_modified):
+        # the usual heuristic: a tenth of the time since it last changed
+        lifetime = (date - parse_http_date(last_modified)) / 10
+    else:
+        lifetime = 0
+
+    # time the response already spent in caches on its way to us
+    try:
+        lifetime -= int(headers.get("age", "0"))
+    except ValueError:
+        pass
+
+    # nothing to gain from an entry we could neither use nor revalidate
+    if lifetime <= 0 and not etag and not last_modified:
+        return None
+    return CacheEntry(body, etag, last_modified, now + lifetime, fetch_time)
+
+
+# shared by every tab
+CACHE = HTTPCache()
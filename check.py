@@ -0,0 +1,341 @@
+"""
+Differential checks for the parts of the browser that were rewritten for
+speed: each fast version is run side by side with a simple, obviously
+right one on many random inputs, and any input where they disagree is
+printed. Run these after changing the code they cover.
+
+    python3 check.py css [--cases N] [--seed S]
+    python3 check.py relayout [--cases N] [--seed S]
+    python3 check.py hit-test [--cases N] [--seed S]
+
+The css mode compares CSSParser with the character-at-a-time parser it
+replaced, kept below as ReferenceCSSParser: the rules parse() returns,
+and where body() and selector() stop or fail, must be the same. The
+relayout mode makes random edits to a page, of the kinds scripts, clicks
+and typing make, and after each compares the incrementally restyled,
+laid out and painted page with one done from scratch: every layout
+object's box and the display list must be the same. Pages laid out
+lazily are also checked after each slice: everything painted above where
+the slice stopped must match the whole page's display list, backgrounds
+of blocks not yet finished included. The hit-test mode clicks random
+points on pages part laid out, fully laid out and relaid out after
+edits, and compares hit_test with a scan of every layout object. Layout
+checks measure text with the headless font backend, so they need no
+display.
+"""
+
+import argparse
+import random
+import sys
+
+from fontbackend import HeadlessFontBackend
+from htmlparser import HTMLParser, Element, mark_dirty
+from layout import DocumentLayout, BlockLayout, contains_point
+from style import CSSParser, TagSelector, DescendantSelector, \
+    selector_tags, StyleSheet, Cascade, style, restyle
+from utils import iter_tree, use_font_backend
+
+
+class ReferenceCSSParser:
+    """ the original CSSParser, which reads one character at a time """
+    def __init__(self, s):
+        self.s = s
+        self.i = 0
+
+    def whitespace(self):
+        while self.i < len(self.s) and self.s[self.i].isspace():
+            self.i += 1
+
+    def word(self):
+        start = self.i
+        while self.i < len(self.s):
+            if self.s[self.i].isalnum() or self.s[self.i] in "#-.%":
+                self.i += 1
+            else:
+                break
+        if not (self.i > start):
+            raise Exception("Parsing Error")
+        return self.s[start:self.i]
+
+    def literal(self, literal):
+        if not (self.i < len(self.s) and self.s[self.i] == literal):
+            raise Exception("Parsing Error")
+        self.i += 1
+
+    def pair(self):
+        prop = self.word()
+        self.whitespace()
+        self.literal(":")
+        self.whitespace()
+        val = self.word()
+        return prop.casefold(), val
+
+    def ignore_until(self, chars):
+        while self.i < len(self.s):
+            if self.s[self.i] in chars:
+                return self.s[self.i]
+            else:
+                self.i += 1
+        return None
+
+    def body(self):
+        pairs = {}
+        while self.i < len(self.s) and self.s[self.i] != "}":
+            try:
+                prop, val = self.pair()
+                pairs[prop.casefold()] = val
+                self.whitespace()
+                self.literal(";")
+                self.whitespace()
+            except Exception:
+                why = self.ignore_until([";", "}"])
+                if why == ";":
+                    self.literal(";")
+                    self.whitespace()
+                else:
+                    break
+        return pairs
+
+    def selector(self):
+        out = TagSelector(self.word().casefold())
+        self.whitespace()
+        while self.i < len(self.s) and self.s[self.i] != "{":
+            tag = self.word()
+            descendant = TagSelector(tag.casefold())
+            out = DescendantSelector(out, descendant)
+            self.whitespace()
+        return out
+
+    def parse(self):
+        rules = []
+        while self.i < len(self.s):
+            try:
+                self.whitespace()
+                selector = self.selector()
+                self.literal("{")
+                self.whitespace()
+                body = self.body()
+                self.literal("}")
+                rules.append((selector, body))
+            except Exception:
+                why = self.ignore_until(["}"])
+                if why == "}":
+                    self.literal("}")
+                    self.whitespace()
+                else:
+                    break
+        return rules
+
+
+# pieces random stylesheets are made of, chosen to hit every branch of both
+# parsers: words, separators, at-rules, comments, strings and non-ASCII
+CSS_PIECES = list("ab#.%-_ :;{}>,@()'\"!\n\t/*") + \
+    ["div", "p", "color", "red", " ", "é", " ", "1", "²"]
+
+def random_css(rng):
+    return "".join(rng.choice(CSS_PIECES)
+                   for _ in range(rng.randint(0, 30)))
+
+def parsed_rules(parser):
+    return [(selector_tags(selector), body)
+            for selector, body in parser.parse()]
+
+def selector_or_error(parser):
+    try:
+        return selector_tags(parser.selector())
+    except Exception:
+        return "error"
+
+def check_css(cases, seed):
+    rng = random.Random(seed)
+    texts = [open("browser.css").read()] + \
+        [random_css(rng) for _ in range(cases)]
+    for text in texts:
+        if parsed_rules(CSSParser(text)) != \
+            parsed_rules(ReferenceCSSParser(text)):
+            return "parse() differs on " + repr(text)
+        fast, reference = CSSParser(text), ReferenceCSSParser(text)
+        if fast.body() != reference.body() or fast.i != reference.i:
+            return "body() differs on " + repr(text)
+        if selector_or_error(CSSParser(text)) != \
+            selector_or_error(ReferenceCSSParser(text)):
+            return "selector() differs on " + repr(text)
+    return None
+
+
+# backgrounds at several levels, since a block's height shows in its own
+# and its ancestors' background rects
+CHECK_STYLE_SHEET = """
+body { background-color: #eee }
+section { background-color: #ddd }
+h1 { background-color: red }
+"""
+
+def random_page(rng, sections):
+    # with a word too long for the line and a bigger font in the middle of
+    # a line, so that some boxes overlap their neighbours
+    return "<html><body>" + "".join(
+        "<section><h1>Title {}</h1><p>hello world <b>bold</b> {}"
+        "averyveryveryverylongwordthatoverflowsthelinewidthbyaboutthismuch"
+        "xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx <span style='font-size:200%'>"
+        "big</span></p>"
+        "<div>input <input name=q{}> and <span>inline</span> {}</div>"
+        "</section>".format(i, "word " * rng.randint(0, 40), i,
+                            "more " * rng.randint(0, 40))
+        for i in range(sections)) + "</body></html>"
+
+def random_edit(rng, nodes):
+    elements = [node for node in iter_tree(nodes)
+                if isinstance(node, Element)][2:]
+    kind = rng.randrange(4)
+    if kind == 0:
+        # a script setting innerHTML
+        element = rng.choice(elements)
+        HTMLParser("<p>new " + "word " * rng.randint(0, 60) +
+                   "</p><b>x</b>").parse_fragment(element)
+    elif kind == 1:
+        element = rng.choice(elements)
+        element.attributes["style"] = "font-size:{}%".format(
+            rng.choice([50, 100, 200]))
+        mark_dirty(element)
+    else:
+        # focusing an input, or typing into one
+        inputs = [element for element in elements if element.tag == "input"]
+        if not inputs: return
+        element = rng.choice(inputs)
+        element.is_focused = kind == 2 or not element.is_focused
+        element.attributes["value"] = \
+            element.attributes.get("value", "") + "k" * rng.randint(0, 3)
+        mark_dirty(element)
+
+def layout_boxes(document):
+    return [(type(obj).__name__, obj.x, obj.y, obj.width, obj.height)
+            for obj in iter_tree(document)]
+
+def painted(display_list):
+    return [(type(cmd).__name__, getattr(cmd, "text", None),
+             getattr(cmd, "color", None), cmd.rect.left, cmd.rect.top,
+             cmd.rect.right, cmd.rect.bottom) for cmd in display_list]
+
+def painted_above(display_list, y):
+    # what shows of the page above y, as the first screenful would
+    return [(kind, text, color, left, top, right, min(bottom, y))
+            for kind, text, color, left, top, right, bottom
+            in painted(display_list) if top < y]
+
+def check_relayout(cases, seed):
+    use_font_backend(HeadlessFontBackend())
+    index = Cascade([StyleSheet(open("browser.css").read()),
+                     StyleSheet(CHECK_STYLE_SHEET)]).index
+    rng = random.Random(seed)
+    # a fresh page every so many edits, so that edits pile up on each other
+    # but different pages get a turn
+    for page in range(0, cases, 20):
+        nodes = HTMLParser(random_page(rng, rng.randint(1, 60))).parse()
+        style(nodes, index)
+        document = DocumentLayout(nodes)
+        display_list = []
+        if page % 40:
+            document.layout(display_list)
+        else:
+            # laid out lazily, a slice at a time, as Tab does; the part laid
+            # out after each slice must look as it does on the whole page
+            whole_display_list = []
+            DocumentLayout(nodes).layout(whole_display_list)
+            document.start()
+            y = 0
+            while not document.done:
+                y += 500
+                document.resume(y, display_list)
+                if painted_above(display_list, y) != \
+                    painted_above(whole_display_list, y):
+                    return "lazy layout to {} differs on page {}".format(
+                        y, page)
+        for edit in range(page, min(page + 20, cases)):
+            random_edit(rng, nodes)
+            document.relayout(restyle(nodes, index), display_list)
+
+            style(nodes, index)
+            fresh = DocumentLayout(nodes)
+            fresh_display_list = []
+            fresh.layout(fresh_display_list)
+            if layout_boxes(document) != layout_boxes(fresh):
+                return "layout differs after edit " + str(edit)
+            if painted(display_list) != painted(fresh_display_list):
+                return "display list differs after edit " + str(edit)
+            blocks = [obj for obj in iter_tree(document)
+                      if isinstance(obj, BlockLayout)]
+            if len(blocks) != len(document.blocks) or any(
+                document.blocks[block.node] is not block
+                for block in blocks):
+                return "blocks map is stale after edit " + str(edit)
+    return None
+
+
+def hit_test_by_scan(document, x, y):
+    # the last object in tree order whose box holds the point
+    hit = None
+    for obj in iter_tree(document):
+        if contains_point(obj, x, y): hit = obj
+    return hit
+
+def check_hit_test(cases, seed):
+    use_font_backend(HeadlessFontBackend())
+    index = Cascade([StyleSheet(open("browser.css").read())]).index
+    rng = random.Random(seed)
+
+    def click(document, clicks):
+        # a little beyond the page on every side too
+        for _ in range(clicks):
+            x = rng.uniform(-10, 1300)
+            y = rng.uniform(-10, document.y + document.height + 50)
+            if document.hit_test(x, y) is not \
+                hit_test_by_scan(document, x, y):
+                return "hit_test differs at " + repr((x, y))
+        return None
+
+    # a page at a time, with a tenth of the clicks at each of its stages
+    for page in range(0, cases, 100):
+        nodes = HTMLParser(random_page(rng, rng.randint(1, 60))).parse()
+        style(nodes, index)
+        document = DocumentLayout(nodes)
+        display_list = []
+        document.start()
+        document.resume(rng.uniform(0, 3000), display_list)
+        failure = click(document, 10)
+        if failure: return "part laid out, " + failure
+        document.resume(None, display_list)
+        failure = click(document, 10)
+        if failure: return failure
+        for edit in range(8):
+            random_edit(rng, nodes)
+            document.relayout(restyle(nodes, index), display_list)
+            failure = click(document, 10)
+            if failure: return "after edit {}, {}".format(edit, failure)
+    return None
+
+
+# each check and how many cases it runs by default, about ten seconds' worth
+CHECKS = {"css": (check_css, 200000), "relayout": (check_relayout, 400),
+          "hit-test": (check_hit_test, 10000)}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = __doc__.split("\n")[1])
+    modes = parser.add_subparsers(dest = "mode", required = True)
+    for name, (check, cases) in CHECKS.items():
+        mode = modes.add_parser(name)
+        mode.add_argument("--cases", type = int, default = cases)
+        mode.add_argument("--seed", type = int, default = 0)
+    args = parser.parse_args(argv)
+
+    check, cases = CHECKS[args.mode]
+    failure = check(args.cases, args.seed)
+    if failure:
+        print(args.mode + ": " + failure)
+        sys.exit(1)
+    print(args.mode + ": ok, " + str(args.cases) + " cases")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,264 @@
+import socket
+# encrypted HTTPS connections
+import ssl
+import threading
+import time
+
+# seconds an unused keep-alive socket may sit in the pool before we drop it;
+# servers usually close idle connections on their side after a similar delay
+IDLE_TIMEOUT = 15
+# same limit real browsers use for HTTP/1.1 connections to one origin
+MAX_CONNECTIONS_PER_HOST = 6
+# seconds a resolved address is trusted
+DNS_TTL = 60
+
+# building a context loads the whole CA store, so every connection shares one
+SSL_CONTEXT = ssl.create_default_context()
+# last TLS session seen for each (host, port), offered for resumption
+TLS_SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+
+
+class DNSCache:
+    """
+    getaddrinfo goes to the system resolver on every call, so answers are
+    remembered for ttl seconds. The resolver doesn't tell us the record's real
+    TTL, so a short fixed one keeps us from holding on to a moved host.
+    """
+    def __init__(self, ttl = DNS_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, host, port):
+        """ returns every (family, address) the resolver gave, in its order
+        of preference, e.g. IPv6 first and then IPv4 """
+        key = (host, port)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and now < entry[0]:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        addresses = [(family, address) for family, _, _, _, address in
+                     socket.getaddrinfo(host, port, type = socket.SOCK_STREAM,
+                                        proto = socket.IPPROTO_TCP)]
+        with self.lock:
+            self.entries[key] = (now + self.ttl, addresses)
+        return addresses
+
+    def prefer(self, host, port, address):
+        """ moves an address that worked to the front, so that later
+        connections don't try the ones that failed before it first """
+        with self.lock:
+            entry = self.entries.get((host, port))
+            if entry and entry[1][0] != address:
+                addresses = [address] + \
+                    [other for other in entry[1] if other != address]
+                self.entries[(host, port)] = (entry[0], addresses)
+
+    def forget(self, host, port):
+        with self.lock:
+            self.entries.pop((host, port), None)
+
+
+class Connection:
+    def __init__(self, scheme, host, port):
+        self.key = (scheme, host, port)
+        self.reused = False
+        self.resumed = False
+        # whether the current request has had any response back yet
+        self.answered = False
+
+        # seconds spent on each step of setting the connection up
+        start = time.monotonic()
+        addresses = DNS.resolve(host, port)
+        resolved = time.monotonic()
+
+        """ like socket.create_connection, try each address in turn: a host
+        whose first answer is IPv6 must still be reachable from a machine
+        without an IPv6 route """
+        for i, (family, address) in enumerate(addresses):
+            s = None
+            try:
+                # create socket; this too fails where a family is unsupported
+                s = socket.socket(
+                    family = family,
+                    type = socket.SOCK_STREAM,
+                    # computer can send arbitrary amounts of data
+                    proto = socket.IPPROTO_TCP,
+                )
+                # connect socket to host
+                s.connect(address)
+                break
+            except OSError:
+                if s: s.close()
+                if i == len(addresses) - 1:
+                    # the cached addresses may be the reason, look them up
+                    # afresh next time
+                    DNS.forget(host, port)
+                    raise
+        if i > 0:
+            DNS.prefer(host, port, (family, address))
+        connected = time.monotonic()
+        # requires host and port - port depends on protocol used
+        if scheme == "https":
+            """ offering the session from our last connection to this host
+            lets the server skip the certificate exchange and key agreement
+            of a full handshake """
+            with SESSIONS_LOCK:
+                session = TLS_SESSIONS.get((host, port))
+            try:
+                s = SSL_CONTEXT.wrap_socket(s, server_hostname = host,
+                                            session = session)
+            except:
+                s.close()
+                raise
+            self.resumed = s.session_reused
+        self.socket = s
+        handshaken = time.monotonic()
+
+        self.timing = {
+            "dns": resolved - start,
+            "connect": connected - resolved,
+            "tls": handshaken - connected,
+        }
+
+        """ a binary file, rather than a text one, so that Content-Length can
+        be honoured byte for byte and the next response on the same socket
+        starts exactly where this one ends """
+        self.file = s.makefile("rb")
+        self.last_used = time.monotonic()
+
+    def __repr__(self):
+        scheme, host, port = self.key
+        return f"Connection({scheme}://{host}:{port})"
+
+    def save_session(self):
+        """ TLS 1.3 servers send their session tickets after the handshake,
+        so the session is only worth saving once a response has been read """
+        session = getattr(self.socket, "session", None)
+        if session:
+            scheme, host, port = self.key
+            with SESSIONS_LOCK:
+                TLS_SESSIONS[(host, port)] = session
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+class ConnectionPool:
+    """
+    Keeps sockets open between requests so that a page and all of its
+    stylesheets and scripts, and every tab showing the same site, share a
+    handful of TCP connections and TLS handshakes instead of paying for one
+    per resource. Connections are keyed by (scheme, host, port).
+    """
+    def __init__(self, idle_timeout = IDLE_TIMEOUT,
+                 max_per_host = MAX_CONNECTIONS_PER_HOST):
+        self.idle_timeout = idle_timeout
+        self.max_per_host = max_per_host
+
+        self.idle = {}
+        # number of open connections, idle or busy, for each key
+        self.open = {}
+        """ one condition for every key, so a slot freed for one host must
+        wake all the waiters: notify() could wake only one waiting for
+        another, still full, host, which goes back to sleep """
+        self.lock = threading.Condition()
+
+        self.hits = 0
+        self.misses = 0
+        self.handshakes = 0
+        # handshakes that resumed an earlier TLS session
+        self.resumptions = 0
+
+    def acquire(self, scheme, host, port):
+        key = (scheme, host, port)
+        with self.lock:
+            while True:
+                self.expire()
+                idle = self.idle.get(key)
+                if idle:
+                    # most recently used first, it is the least likely to
+                    # have been closed by the server
+                    conn = idle.pop()
+                    conn.reused = True
+                    self.hits += 1
+                    return conn
+                if self.open.get(key, 0) < self.max_per_host:
+                    break
+                self.lock.wait()
+            self.open[key] = self.open.get(key, 0) + 1
+            self.misses += 1
+
+        # connect outside the lock so other hosts aren't held up
+        try:
+            conn = Connection(scheme, host, port)
+        except:
+            with self.lock:
+                self.open[key] -= 1
+                self.lock.notify_all()
+            raise
+        with self.lock:
+            self.handshakes += 1
+            if conn.resumed:
+                self.resumptions += 1
+        return conn
+
+    def release(self, conn, reuse = True):
+        with self.lock:
+            self.expire()
+            if reuse:
+                conn.save_session()
+                conn.last_used = time.monotonic()
+                self.idle.setdefault(conn.key, []).append(conn)
+            else:
+                conn.close()
+                self.open[conn.key] -= 1
+            self.lock.notify_all()
+
+    def expire(self):
+        """ closes idle sockets past their timeout for every host, not just
+        the one being asked for, or a host we never go back to would keep
+        its sockets open, half-closed once the server gives up on them """
+        now = time.monotonic()
+        expired = False
+        for key, idle in self.idle.items():
+            while idle and now - idle[0].last_used > self.idle_timeout:
+                idle.pop(0).close()
+                self.open[key] -= 1
+                expired = True
+        # the freed slots may be what another host's waiters are waiting on
+        if expired: self.lock.notify_all()
+
+    def close_all(self):
+        with self.lock:
+            for key, idle in self.idle.items():
+                for conn in idle:
+                    conn.close()
+                self.open[key] -= len(idle)
+            self.idle = {}
+            self.lock.notify_all()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "handshakes": self.handshakes,
+                "resumptions": self.resumptions,
+                "dns_hits": DNS.hits,
+                "dns_misses": DNS.misses,
+                "open": sum(self.open.values()),
+                "idle": sum(len(idle) for idle in self.idle.values()),
+            }
+
+
+# shared by every URL, and so by every tab
+DNS = DNSCache()
+POOL = ConnectionPool()
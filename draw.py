@@ -46,7 +46,7 @@ class DrawText:
     def __init__(self, x, y, text, font, color):
         self.rect = Rect(
             x, y, x + font.measure(text), 
-            y + font.metrics("linespace"))
+            y + font.linespace)
         self.text = text
         self.font = font
         self.color = color
@@ -0,0 +1,116 @@
+"""
+Font backends make the fonts that getfont hands to layout. The Tk backend
+is the real thing and needs a Tk root, and so a display. The headless one
+measures text from tables of per-character advance widths, so layout can
+run in a server, a worker process or CI, deterministically and without a
+single round trip into Tcl:
+
+    utils.use_font_backend(HeadlessFontBackend())
+"""
+
+import json
+
+# Tk font sizes are in points, and a point is 96/72 pixels
+PIXELS_PER_POINT = 96 / 72
+
+"""
+Advance widths, in thousandths of an em, of Helvetica and Helvetica-Bold
+for the printable ASCII characters from " " to "~", the same as Arial's.
+Other characters get the average width. Oblique faces share the upright
+widths. Ascent and descent are Arial's, as fractions of an em.
+"""
+HELVETICA_ADVANCES = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333,
+    278, 278, 556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278,
+    584, 584, 584, 556, 1015, 667, 667, 722, 722, 667, 611, 778, 722, 278,
+    500, 667, 556, 833, 722, 778, 667, 778, 722, 667, 611, 722, 667, 944,
+    667, 667, 611, 278, 278, 278, 469, 556, 333, 556, 556, 500, 556, 556,
+    278, 556, 556, 222, 222, 500, 222, 833, 556, 556, 556, 556, 333, 500,
+    278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584]
+HELVETICA_BOLD_ADVANCES = [
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333,
+    278, 278, 556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333,
+    584, 584, 584, 611, 975, 722, 722, 722, 722, 667, 611, 778, 722, 278,
+    556, 722, 611, 833, 722, 778, 667, 778, 722, 667, 611, 722, 667, 944,
+    667, 667, 611, 333, 278, 333, 584, 556, 333, 556, 611, 556, 611, 556,
+    333, 611, 611, 278, 278, 556, 278, 889, 611, 611, 611, 611, 389, 556,
+    333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584]
+
+DEFAULT_METRICS = {
+    "units_per_em": 1000,
+    "ascent": 905,
+    "descent": 212,
+    "default_advance": 556,
+    "advances": {
+        "normal": {chr(32 + i): width
+                   for i, width in enumerate(HELVETICA_ADVANCES)},
+        "bold": {chr(32 + i): width
+                 for i, width in enumerate(HELVETICA_BOLD_ADVANCES)},
+    },
+}
+
+
+def load_font_metrics(path):
+    """ reads metrics for HeadlessFontBackend from a JSON file laid out like
+    DEFAULT_METRICS, e.g. one extracted from a real font's tables """
+    with open(path, encoding = "utf8") as f:
+        return json.load(f)
+
+
+class TkFontBackend:
+    def create(self, size, weight, style):
+        # imported here so that headless layout doesn't need Tk installed
+        import tkinter
+        import tkinter.font
+        font = tkinter.font.Font(
+            size = size,
+            weight = weight,
+            slant = style
+        )
+        label = tkinter.Label(font = font)
+        # what does this do?
+        return font, label
+
+
+class HeadlessFontBackend:
+    def __init__(self, metrics = DEFAULT_METRICS):
+        self.metrics = metrics
+
+    def create(self, size, weight, style):
+        return HeadlessFont(self.metrics, size, weight), None
+
+
+class AdvanceTable(dict):
+    """ advances by character, with a default for characters not listed """
+    def __init__(self, advances, default):
+        super().__init__(advances)
+        self.default = default
+
+    def __missing__(self, char):
+        return self.default
+
+
+class HeadlessFont:
+    """ answers measure() and metrics() the way a Tk font does """
+    def __init__(self, metrics, size, weight):
+        advances = metrics["advances"]
+        self.advances = AdvanceTable(
+            advances.get(weight, advances["normal"]),
+            metrics["default_advance"])
+        # tkinter takes negative sizes to be in pixels
+        pixels = -size if size < 0 else size * PIXELS_PER_POINT
+        self.scale = pixels / metrics["units_per_em"]
+        self.ascent = round(metrics["ascent"] * self.scale)
+        self.descent = round(metrics["descent"] * self.scale)
+
+    def measure(self, text):
+        return round(sum(map(self.advances.__getitem__, text)) * self.scale)
+
+    def metrics(self, option = None):
+        metrics = {
+            "ascent": self.ascent,
+            "descent": self.descent,
+            "linespace": self.ascent + self.descent,
+            "fixed": 0,
+        }
+        return metrics if option is None else metrics[option]
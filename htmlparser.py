@@ -1,48 +1,192 @@
+import re
+import sys
+
+# shared by every leaf node; a tuple so that nothing can append to it
+NO_CHILDREN = ()
+
+
 class Text:
+    """ slots instead of a __dict__ make each of a large DOM's many nodes a
+    fraction of the size, and attribute access a little faster """
+    __slots__ = ("text", "children", "parent", "is_focused", "style",
+                 "dirty", "children_dirty")
+
     def __init__(self, text, parent):
         self.text = text
-        self.children = []
+        self.children = NO_CHILDREN
         self.parent = parent
         self.is_focused = False
+        # set while the node's style is out of date; new nodes have none yet
+        self.dirty = True
+        # set while some node below this one is dirty
+        self.children_dirty = False
         
     def __repr__(self):
         return repr(self.text)
     
         
 class Element:
-    def __init__(self, tag, attributes, parent):
+    __slots__ = ("tag", "attributes", "children", "parent", "is_focused",
+                 "style", "dirty", "children_dirty")
+
+    def __init__(self, tag, attributes, parent, children = None):
         self.tag = tag
         self.attributes = attributes
-        self.children = []
+        self.children = [] if children is None else children
         self.parent = parent
         self.is_focused = False
+        self.dirty = True
+        self.children_dirty = False
     
     def __repr__(self):
         return "<" + self.tag + ">"
 
 
+def mark_dirty(node):
+    """
+    Records that node, and so everything below it, needs restyling after a
+    mutation. Its ancestors are flagged on the way up so a restyle can find
+    it without visiting clean subtrees; the walk stops at the first ancestor
+    that was already flagged.
+    """
+    node.dirty = True
+    node = node.parent
+    while node and not node.children_dirty:
+        node.children_dirty = True
+        node = node.parent
+
+
+class Attributes:
+    """
+    Most elements have no attributes or just one, and a dict is a lot of
+    memory for that, so this holds a single pair in slots and only creates a
+    dict once a second attribute is added. Supports the dict operations the
+    browser uses.
+    """
+    __slots__ = ("key", "value", "more")
+
+    def __init__(self, key = None, value = None):
+        self.key = key
+        self.value = value
+        self.more = None
+
+    def __getitem__(self, key):
+        if self.more is not None: return self.more[key]
+        if key == self.key and key is not None: return self.value
+        raise KeyError(key)
+
+    def get(self, key, default = None):
+        if self.more is not None: return self.more.get(key, default)
+        if key == self.key and key is not None: return self.value
+        return default
+
+    def __contains__(self, key):
+        if self.more is not None: return key in self.more
+        return key == self.key and key is not None
+
+    def __setitem__(self, key, value):
+        if self.more is not None:
+            self.more[key] = value
+        elif self.key is None or key == self.key:
+            self.key, self.value = intern_name(key), value
+        else:
+            self.more = {self.key: self.value, intern_name(key): value}
+            self.key = self.value = None
+
+    def __delitem__(self, key):
+        if self.more is not None:
+            del self.more[key]
+        elif key == self.key and key is not None:
+            self.key = self.value = None
+        else:
+            raise KeyError(key)
+
+    def items(self):
+        if self.more is not None: return self.more.items()
+        return [(self.key, self.value)] if self.key is not None else []
+
+    def keys(self):
+        return [key for key, value in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        if self.more is not None: return len(self.more)
+        return 0 if self.key is None else 1
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+# every element with the same tag, or the same attribute name, points at one
+# shared string, which also makes comparing them an identity check
+intern_name = sys.intern
+
+# tag text without attributes, e.g. "div" or "/P", to its interned tag name
+TAG_NAMES = {}
+# likewise for attribute names as written, e.g. "HREF"
+ATTRIBUTE_NAMES = {}
+
+def attribute_name(key):
+    name = intern_name(key.casefold())
+    if len(ATTRIBUTE_NAMES) < 10000: ATTRIBUTE_NAMES[key] = name
+    return name
+
+
 class HTMLParser:
+    HEAD_TAGS = {"base", "basefont", "bgsound", "noscript", "link", "meta",
+                 "title", "style", "script"}
+    SELF_CLOSING_TAGS = {"area", "base", "br", "col", "embed", "hr", "img",
+                         "input", "link", "meta", "param", "source", "track",
+                         "wbr"}
+
     def __init__(self, body):
-        self.HEAD_TAGS = ["base", "basefont", "bgsound", "noscript", "link", "meta",
-                     "title", "style", "script"]
         self.body = body
+        # how far into body parsing has got
+        self.i = 0
+        # chunks fed since body was last parsed, not yet joined onto it
+        self.pending = []
+        # what tokenize stopped to wait for, e.g. "-->" to end a comment
+        self.waiting_for = None
+        # the last few characters fed, in case waiting_for straddles chunks
+        self.tail = ""
         self.unfinished = []
-        self.SELF_CLOSING_TAGS = ["area", "base", "br", "col", "embed", "hr", 
-                                  "img", "input", "link", "meta", "param", 
-                                  "source", "track", "wbr"]
+        self.mode = "initial"
         
+    def update_mode(self):
+        """
+        Where we are in the implied <html><head></head><body> structure.
+        Only the bottom two open elements matter, so this is O(1) however
+        deep the document gets, and is called after every push and pop:
+            "initial"     nothing open yet
+            "before head" only <html> open
+            "in head"     <html><head> open
+            "in body"     anything else
+        """
+        depth = len(self.unfinished)
+        if depth == 0:
+            self.mode = "initial"
+        elif depth == 1 and self.unfinished[0].tag == "html":
+            self.mode = "before head"
+        elif depth == 2 and self.unfinished[0].tag == "html" and \
+            self.unfinished[1].tag == "head":
+            self.mode = "in head"
+        else:
+            self.mode = "in body"
+
     def implicit_tags(self, tag):
         while True:
-            open_tags = [node.tag for node in self.unfinished]
-            if open_tags == [] and tag != "html":
+            if self.mode == "initial" and tag != "html":
                 self.add_tag("html")
-            elif open_tags == ["html"] and tag not in ["head", "body", "/html"]:
+            elif self.mode == "before head" and \
+                tag not in ["head", "body", "/html"]:
                 if tag in self.HEAD_TAGS:
                     self.add_tag("head")
                 else:
                     self.add_tag("body")
-            elif open_tags == ["html", "head"] and \
-                tag not in ["/head"] + self.HEAD_TAGS:
+            elif self.mode == "in head" and tag != "/head" and \
+                tag not in self.HEAD_TAGS:
                 self.add_tag("/head")
             else:
                 break
@@ -51,67 +195,241 @@ class HTMLParser:
         if text.isspace(): return
         """ HTMLParser interprets HTML newlines as text and tries to add it to 
         tree. Will not work for newline after thrown away doctype tag """
-        self.implicit_tags(None)
+        # once in the body no more tags are implied
+        if self.mode != "in body": self.implicit_tags(None)
         parent = self.unfinished[-1]
         node = Text(text, parent)
         parent.children.append(node)
         
     def get_attributes(self, text):
-        parts = text.split()
-        # we are ignoring values that contatin whitespace - more complicated
-        tag = parts[0].casefold()
-        attributes = {}
-        for attrpair in parts[1:]:
-            if "=" in attrpair:
-                key, value = attrpair.split("=", 1)
-                if len(value) > 2 and value[0] in ["'", "\""]:
-                    value = value[1:-1]
-                # strip value quotes if there are any
-                attributes[key.casefold()] = value
-            else:
-                attributes[attrpair.casefold()] = ""
-        return tag, attributes
+        # most tags carry no attributes, and keep recurring
+        tag = TAG_NAMES.get(text)
+        if tag: return tag, Attributes()
+        # <br/> and <br /> are the same tag as <br>
+        original = text
+        if text.endswith("/") and (" " not in text or text[-2] in " \"'"):
+            text = text[:-1]
+        parts = text.split(None, 1)
+        if len(parts) < 2:
+            if not parts: return "", Attributes()
+            tag = intern_name(parts[0].casefold())
+            # keyed like the lookup above, before any "/" came off
+            if len(TAG_NAMES) < 10000: TAG_NAMES[original] = tag
+            return tag, Attributes()
+        tag = intern_name(parts[0].casefold())
+        pairs = []
+        """ quoted values may contain whitespace, so attributes are matched
+        as name, optional "=", then a quoted or unquoted value """
+        for match in ATTRIBUTE.finditer(parts[1]):
+            key, value = match.group(1), match.group(2) or ""
+            if len(value) >= 2 and value[0] in ["'", "\""] and \
+                value[-1] == value[0]:
+                value = value[1:-1]
+            # strip value quotes if there are any
+            pairs.append((intern_name(key.casefold()), value))
+        if len(pairs) == 1:
+            return tag, Attributes(*pairs[0])
+        return tag, dict(pairs) if pairs else Attributes()
         
-    def add_tag(self, tag):
-        tag, attributes = self.get_attributes(tag)
-        if tag.startswith("!"): return
+    def add_tag(self, text):
+        tag, attributes = self.get_attributes(text)
         # we are throwing out the doctype html tag
-        self.implicit_tags(tag)
+        if not tag or tag.startswith("!"): return
+        self.add_element(tag, attributes)
+
+    def add_matched_tag(self, match):
+        # a tag TAG matched: its name and attributes are already split up
+        name, attributes = match.group(1, 2)
+        tag = TAG_NAMES.get(name)
+        if not tag:
+            tag = intern_name(name.casefold())
+            if len(TAG_NAMES) < 10000: TAG_NAMES[name] = tag
+        if not attributes:
+            # a closing tag has no use for its attributes
+            self.add_element(tag, None if name[0] == "/" else Attributes())
+            return
+        pairs = [(ATTRIBUTE_NAMES.get(key) or attribute_name(key),
+                  double or single or bare)
+                 for key, double, single, bare
+                 in ATTRIBUTE_PAIR.findall(attributes)]
+        if len(pairs) == 1:
+            self.add_element(tag, Attributes(*pairs[0]))
+        else:
+            self.add_element(tag, dict(pairs))
+
+    def add_element(self, tag, attributes):
+        if self.mode != "in body": self.implicit_tags(tag)
         if tag.startswith("/"):
             if len(self.unfinished) == 1: return
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+            self.unfinished.pop()
+            self.update_mode()
         elif tag in self.SELF_CLOSING_TAGS:
             parent = self.unfinished[-1]
-            node = Element(tag, attributes, parent)
+            node = Element(tag, attributes, parent, NO_CHILDREN)
             parent.children.append(node)
         else:
+            """ nodes join their parent as soon as they open, not when they
+            close, so that a partially parsed document is already a
+            complete tree that can be rendered """
             parent = self.unfinished[-1] if self.unfinished else None
             node = Element(tag, attributes, parent)
+            if parent: parent.children.append(node)
             self.unfinished.append(node)
+            self.update_mode()
             
     def finish(self):
-        while len(self.unfinished) > 1:
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
-        return self.unfinished.pop()
+        root = self.unfinished[0]
+        self.unfinished = []
+        self.update_mode()
+        return root
             
     def parse(self):
-        text = ""
-        in_tag = False
-        for c in self.body:
-            if c == "<":
-                in_tag = True
-                if text: self.add_text(text)
-                text = ""
-            elif c == ">":
-                in_tag = False
-                self.add_tag(text)
-                text = ""
-            else:
-                text += c
-        if not in_tag and text:
-            self.add_text(text)
-        return self.finish()
\ No newline at end of file
+        self.tokenize(final = True)
+        return self.finish()
+
+    def parse_fragment(self, context):
+        """
+        Parses body as the new contents of the context element, the way
+        innerHTML does: there are no implied <html>, <head> or <body> tags,
+        stray closing tags can't escape the context, and the new nodes are
+        attached to it directly. The context is marked dirty so that later
+        stages know which subtree changed.
+        """
+        context.children = []
+        mark_dirty(context)
+        self.unfinished = [context]
+        self.update_mode()
+        self.tokenize(final = True)
+        self.unfinished = []
+        self.update_mode()
+        return context.children
+
+    def feed(self, chunk):
+        """
+        Adds the next piece of the document, e.g. as it arrives from the
+        network, and parses as much of it as is complete. A tag, comment or
+        text run cut off at the end of the chunk waits for the next one.
+        Until a chunk brings what it is waiting for, chunks are only put
+        aside, so that a long comment or text run arriving in many small
+        chunks isn't copied and rescanned for each of them.
+        """
+        self.pending.append(chunk)
+        recent = self.tail + chunk
+        self.tail = recent[-2:]
+        if self.waiting_for and self.waiting_for not in recent: return
+        self.join_pending()
+        self.tokenize(final = False)
+
+    def join_pending(self):
+        self.body = "".join([self.body[self.i:]] + self.pending)
+        self.pending = []
+        self.i = 0
+        self.waiting_for = None
+
+    def close(self):
+        self.join_pending()
+        self.tokenize(final = True)
+        return self.finish()
+
+    def root(self):
+        # the tree parsed so far, or None before the first node
+        return self.unfinished[0] if self.unfinished else None
+
+    def tokenize(self, final):
+        """
+        Jumps from one "<" to the next ">" with str.find instead of visiting
+        every character, so text runs and tags are sliced out of the body in
+        one go. An ordinary tag is matched, name, attributes and all, by one
+        regex; anything else, e.g. a comment, which is skipped whole since
+        it may contain ">", or malformed markup, goes the slower way round.
+        self.i is left at the first character not yet consumed.
+        """
+        body = self.body
+        i = self.i
+        while i < len(body):
+            start = body.find("<", i)
+            if start == -1:
+                # more text may follow in the next chunk
+                if not final:
+                    self.waiting_for = "<"
+                    break
+                self.add_text(body[i:])
+                i = len(body)
+                break
+            if start > i:
+                self.add_text(body[i:start])
+                i = start
+            match = TAG.match(body, start)
+            if match:
+                i = match.end()
+                # whether a "/" before ">" belongs to the last attribute
+                # depends on the spaces around it, see get_attributes
+                if body[i - 2] == "/" and match.end(1) < i - 2:
+                    self.add_tag(body[start + 1:i - 1])
+                else:
+                    self.add_matched_tag(match)
+                continue
+            if body.startswith("!--", start + 1):
+                end = body.find("-->", start + 4)
+                if end == -1 and not final:
+                    self.waiting_for = "-->"
+                    break
+                i = len(body) if end == -1 else end + 3
+                continue
+            end = body.find(">", start)
+            # only quoted attribute values need the slower scan
+            if end != -1 and ("\"" in body[start:end] or
+                              "'" in body[start:end]):
+                end = self.tag_end(start, final)
+            if end == -1:
+                # an unterminated tag at the end of the body is dropped
+                if final: i = len(body)
+                # unless tag_end is waiting for a closing quote instead
+                elif not self.waiting_for: self.waiting_for = ">"
+                break
+            self.add_tag(body[start + 1:end])
+            i = end + 1
+        self.i = i
+
+    def tag_end(self, start, final):
+        # a ">" inside a quoted attribute value doesn't end the tag
+        i = start
+        while True:
+            match = QUOTE_OR_TAG_END.search(self.body, i)
+            if not match: return -1
+            if match.group() == ">": return match.start()
+            quote = match.group()[-1]
+            close = self.body.find(quote, match.end())
+            if close == -1:
+                # the closing quote may still be on its way
+                if not final:
+                    self.waiting_for = quote
+                    return -1
+                # unbalanced quote, treat it as an ordinary character
+                return self.body.find(">", match.end())
+            i = close + 1
+
+
+# name, then optionally "=" and a double-quoted, single-quoted or bare value
+ATTRIBUTE = re.compile(r"""([^\s=]+)(?:\s*=\s*("[^"]*"|'[^']*'|\S*))?""")
+# the start of a quoted attribute value, or the end of the tag
+QUOTE_OR_TAG_END = re.compile(r"""=\s*["']|>""")
+
+"""
+A well-formed tag in one match: its name, its attributes and the ">". The
+name and bare values can't contain quotes or "=", so the tag ends at the
+same ">" the quote-aware scan in tag_end would find, and the attributes
+split up exactly as get_attributes would split them. Tags this doesn't
+match take the general path.
+"""
+ATTRIBUTE_NAME = r"""[^\s"'=>/]+"""
+QUOTED_OR_BARE = r"""\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=>]+))"""
+TAG = re.compile(
+    r"""<(/?[A-Za-z][^\s"'=>/]*)""" +
+    # the attributes as one span, for ATTRIBUTE_PAIR to split up
+    r"""((?:\s+""" + ATTRIBUTE_NAME +
+    r"""(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s"'=>]+))?)*)""" +
+    r"""\s*/?>""")
+# name, then the double-quoted, single-quoted or bare value, if any
+ATTRIBUTE_PAIR = re.compile(
+    "(" + ATTRIBUTE_NAME + ")(?:" + QUOTED_OR_BARE + ")?")
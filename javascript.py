@@ -32,7 +32,7 @@ class JSContext:
     def querySelectorAll(self, selector_text):
         selector = CSSParser(selector_text).selector()
         nodes = [
-            node for node in tree_to_list(self.tab.nodes, [])
+            node for node in iter_tree(self.tab.nodes)
             if selector.matches(node)
             ]
         return [self.get_handle(node) for node in nodes]
@@ -58,13 +58,9 @@ class JSContext:
         )
         
     def innerHTML_set(self, handle, s):
-        doc = HTMLParser("<html><body>" + s + "</body></html>").parse()
-        new_nodes = doc.children[0].children
-        
+        # parse straight into the element rather than into a throwaway page
         elt = self.handle_to_node[handle]
-        elt.children = new_nodes
-        for child in elt.children:
-            child.parent = elt
+        HTMLParser(s).parse_fragment(elt)
             
         self.tab.render()
         
\ No newline at end of file
@@ -1,3 +1,4 @@
+import bisect
 from draw import *
 from htmlparser import Text, Element
 from utils import *
@@ -21,6 +22,11 @@ class BlockLayout:
         self.y = None
         self.width = None
         self.height = None
+        # see hit_test
+        self.child_tops = None
+        # how many display list commands this block and everything in it
+        # painted, see relayout_block
+        self.painted = None
         
     def __repr__(self):
         return self.node.tag
@@ -44,6 +50,16 @@ class BlockLayout:
             (self.node.tag != "input" and self.node.tag != "button")
         
     def layout(self):
+        """
+        Lays out this block and everything inside it. Nested blocks are laid
+        out from a stack rather than by recursion, so deeply nested pages
+        can't overflow Python's; each block's children are finished, in
+        order, before the block itself, because a block's y comes from its
+        previous sibling's height and its height from its children's.
+        """
+        layout_tree([(self, False, 0)])
+
+    def create_children(self):
         self.x = self.parent.x
         self.width = self.parent.width
         if self.previous:
@@ -69,11 +85,6 @@ class BlockLayout:
             self.new_line()
             self.recurse(self.node)
         
-        for child in self.children:
-            child.layout()
-            
-        self.height = sum([child.height for child in self.children])
-        
     def new_line(self):
         self.cursor_x = 0
         last_line = self.children[-1] if self.children else None
@@ -81,17 +92,21 @@ class BlockLayout:
         self.children.append(new_line)
     
     def recurse(self, node):
-        if isinstance(node, Text):
-            for word in node.text.split():
-                self.word(node, word)
-        else:
-            if node.tag == "br":
-                self.new_line()
-            elif node.tag == "input" or node.tag == "button":
-                self.input(node)
-            if isinstance(node, Element) and not node.tag == "button":
-                for child in node.children:
-                    self.recurse(child)
+        # walks the inline content in document order, with a stack for the
+        # same reason as layout()
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Text):
+                for word in node.text.split():
+                    self.word(node, word)
+            else:
+                if node.tag == "br":
+                    self.new_line()
+                elif node.tag == "input" or node.tag == "button":
+                    self.input(node)
+                if isinstance(node, Element) and not node.tag == "button":
+                    stack.extend(reversed(node.children))
                 
     def word(self, node, word):
         color = node.style["color"]
@@ -112,7 +127,7 @@ class BlockLayout:
         previous_word = line.children[-1] if line.children else None
         text = TextLayout(node, word, line, previous_word)
         line.children.append(text)
-        self.cursor_x += w + font.measure(" ")
+        self.cursor_x += w + font.space_width
                 
     def input(self, node):
         w = INPUT_WIDTH_PX
@@ -129,7 +144,7 @@ class BlockLayout:
         size = int(float(node.style["font-size"][:-2]) * .75)
         font = getfont(size, weight, style)
         
-        self.cursor_x += w + font.measure(" ")
+        self.cursor_x += w + font.space_width
 
     def paint(self):
         cmds = []
@@ -143,6 +158,43 @@ class BlockLayout:
         return cmds
 
 
+def layout_tree(stack, until = None, display_list = None):
+    """
+    Works through a stack of (layout object, finished, paint position)
+    entries as BlockLayout.layout() sets it up. Given until, it stops after
+    the first line that reaches below that y, leaving the stack to carry on
+    from later, and returns that line; it returns None once everything is
+    laid out. Given a display
+    list, objects are painted as they are laid out, a block's commands going
+    in before its children's, where paint_tree would have put them, and
+    each block and line records how many commands it painted.
+    """
+    while stack:
+        block, finished, position = stack.pop()
+        if finished:
+            block.height = sum([child.height for child in block.children])
+            if display_list is not None:
+                if block.should_paint():
+                    display_list[position:position] = block.paint()
+                block.painted = len(display_list) - position
+        elif isinstance(block, BlockLayout):
+            block.create_children()
+            position = len(display_list) if display_list is not None else 0
+            stack.append((block, True, position))
+            stack.extend((child, False, 0)
+                         for child in reversed(block.children))
+        else:
+            block.layout()
+            if display_list is not None:
+                position = len(display_list)
+                paint_tree(block, display_list)
+                block.painted = len(display_list) - position
+            if until is not None and block.y + block.height > until \
+                and stack:
+                return block
+    return None
+
+
 class DocumentLayout:
     def __init__(self, node):
         self.node = node
@@ -153,22 +205,232 @@ class DocumentLayout:
         self.y = None
         self.width = None
         self.height = None
-        
-    def layout(self):
+        # the BlockLayout of every DOM node that has one
+        self.blocks = {}
+        # layout still to do, while laying out lazily
+        self.pending = []
+        self.done = False
+        # (display list index, count) of the stand-in backgrounds painted
+        # for blocks still open when resume() last stopped, outermost first
+        self.provisional = []
+        self.child_tops = None
+        
+    def layout(self, display_list = None):
+        self.start()
+        self.resume(None, display_list)
+
+    def start(self):
+        """
+        Sets up a lazy layout: nothing is laid out until resume() is called,
+        and each call lays out as much more of the page as it is asked to.
+        """
         child = BlockLayout(self.node, self, None)
         self.children.append(child)
 
         self.width = WIDTH - 2 * HSTEP
         self.x = HSTEP
         self.y = VSTEP
-        child.layout()
+        self.height = 0
+        self.pending = [(child, False, 0)]
+        self.provisional = []
+
+    def resume(self, until = None, display_list = None):
+        """
+        Lays out the page down to y = until, or to the end if until is None,
+        painting into display_list if one is given. Until the whole page is
+        done, height is that of the part laid out so far.
+        """
+        if self.done: return
+        # the open blocks' real backgrounds go in when they finish; removing
+        # the outermost first leaves each inner one back at its own index
+        for position, count in self.provisional:
+            del display_list[position:position + count]
+        self.provisional = []
+        line = layout_tree(self.pending, until, display_list)
+        if line:
+            self.height = line.y + line.height - self.y
+            if display_list is not None:
+                self.paint_provisional(line.y + line.height, display_list)
+            return
+        child = self.children[0]
         self.height = child.height
-        
+        self.add_blocks(child)
+        self.done = True
+
+    def paint_provisional(self, bottom, display_list):
+        """
+        A block's background is only painted once all of it is laid out, so
+        a block still open when resume() stops, like a div around the whole
+        page, would show no background in the part already on screen. Each
+        gets one reaching down to bottom, the end of the last line laid
+        out, at the index its real one will go in at. The innermost go in
+        first, so that the outer blocks' indexes still hold.
+        """
+        for block, finished, position in reversed(self.pending):
+            if not finished or not block.should_paint(): continue
+            block.height = bottom - block.y
+            commands = block.paint()
+            block.height = None
+            display_list[position:position] = commands
+            if commands:
+                self.provisional.insert(0, (position, len(commands)))
+
+    def add_blocks(self, layout_object):
+        for block in iter_tree(layout_object):
+            if isinstance(block, BlockLayout):
+                self.blocks[block.node] = block
+        
+    def relayout(self, nodes, display_list):
+        """
+        Updates the layout after the DOM nodes given, and everything below
+        them, have changed, instead of laying the whole document out again.
+        Only the nearest block around each changed node runs line breaking
+        again; every block below it on the page keeps its lines and words
+        and is just moved down or up by however much that block's height
+        changed. The display list, painted as the page was laid out, is
+        patched to match in the same way: the block's own stretch of it is
+        painted again and the commands after it are moved.
+        """
+        blocks = []
+        for node in nodes:
+            # inline content is laid out by the block it sits in
+            while node and node not in self.blocks:
+                node = node.parent
+            if node and self.blocks[node] not in blocks:
+                blocks.append(self.blocks[node])
+        for block in blocks:
+            # a block inside another one being laid out again is redone too
+            parent = block.parent
+            while isinstance(parent, BlockLayout) and parent not in blocks:
+                parent = parent.parent
+            if not isinstance(parent, BlockLayout):
+                self.relayout_block(block, display_list)
+
+    def relayout_block(self, block, display_list):
+        ancestors = self.paint_positions(block)
+        start = ancestors.pop()[1]
+        old_height = block.height
+        old_painted = block.painted
+        for old in iter_tree(block):
+            if isinstance(old, BlockLayout):
+                del self.blocks[old.node]
+        block.children = []
+        block.child_tops = None
+        commands = []
+        layout_tree([(block, False, 0)], display_list = commands)
+        self.add_blocks(block)
+        display_list[start:start + old_painted] = commands
+        for ancestor, position in ancestors:
+            ancestor.painted += block.painted - old_painted
+
+        delta = block.height - old_height
+        if not delta: return
+        # everything after the block, at every level up, moves by delta
+        child = block
+        while isinstance(child, BlockLayout):
+            parent = child.parent
+            # the moved siblings' own indexes are relative, so still good
+            parent.child_tops = None
+            siblings = parent.children
+            for sibling in siblings[siblings.index(child) + 1:]:
+                for layout_object in iter_tree(sibling):
+                    layout_object.y += delta
+            parent.height += delta
+            child = parent
+        # and so does everything after the block in the display list
+        for i in range(start + block.painted, len(display_list)):
+            rect = display_list[i].rect
+            rect.top += delta
+            rect.bottom += delta
+        # the ancestors' backgrounds stretch or shrink with them
+        for ancestor, position in ancestors:
+            if own_commands(ancestor):
+                display_list[position:position + own_commands(ancestor)] = \
+                    ancestor.paint()
+
+    def paint_positions(self, block):
+        """
+        The block and each block around it, outermost first, with the index
+        of its first command in the display list: its parent's, then the
+        parent's own commands, then those of the siblings before it.
+        """
+        chain = []
+        while isinstance(block, BlockLayout):
+            chain.append(block)
+            block = block.parent
+        chain.reverse()
+        positions = [(chain[0], 0)]
+        for parent, block in zip(chain, chain[1:]):
+            siblings = parent.children
+            position = positions[-1][1] + own_commands(parent) + \
+                sum([sibling.painted
+                     for sibling in siblings[:siblings.index(block)]])
+            positions.append((block, position))
+        return positions
+
+    def hit_test(self, x, y):
+        """
+        Returns the deepest layout object at (x, y): the last one in tree
+        order whose box contains it, as a walk over every object would
+        find. Blocks and lines stack downwards without overlapping, and
+        nothing sticks out below its parent, so only the one child whose
+        top is the last at or above y needs searching, and that is found by
+        binary search in child_tops. Words in a line are checked one by
+        one. The whole search is a stack, deepest and latest first.
+        """
+        stack = [(self, False)]
+        while stack:
+            obj, searched = stack.pop()
+            if searched:
+                if contains_point(obj, x, y): return obj
+                continue
+            stack.append((obj, True))
+            if not obj.children: continue
+            if isinstance(obj, LineLayout):
+                stack.extend((child, False) for child in obj.children)
+                continue
+            i = bisect.bisect_right(self.child_tops_of(obj), y - obj.y)
+            candidates = []
+            # float rounding may leave neighbours overlapping by a hair
+            while i > 0:
+                i -= 1
+                child = obj.children[i]
+                if child.height is not None and \
+                    child.y + child.height <= y:
+                    break
+                candidates.append((child, False))
+            # the latest child comes off the stack first
+            stack.extend(reversed(candidates))
+        return None
+
+    def child_tops_of(self, obj):
+        """
+        The tops of obj's children, relative to obj, so that moving a whole
+        subtree after a relayout leaves it correct. Kept once the page is
+        fully laid out, and dropped by relayout_block when it is not.
+        """
+        if obj.child_tops is not None:
+            return obj.child_tops
+        tops = [child.y - obj.y for child in obj.children
+                if child.y is not None]
+        if self.done: obj.child_tops = tops
+        return tops
+
     def should_paint(self):
         return True
         
     def paint(self):
         return []
+
+
+def own_commands(block):
+    # how many commands the block painted for itself, before its children's
+    return block.painted - sum([child.painted for child in block.children])
+
+def contains_point(obj, x, y):
+    # anything not laid out yet has no position, and can't be hit
+    if obj.height is None or obj.width is None: return False
+    return obj.x <= x < obj.x + obj.width and obj.y <= y < obj.y + obj.height
     
     
 class LineLayout:
@@ -178,6 +440,13 @@ class LineLayout:
         self.previous = previous
         self.children = []
         
+        self.x = None
+        self.y = None
+        self.width = None
+        self.height = None
+        # see BlockLayout
+        self.painted = None
+        
     def __repr__(self):
         return "line"
         
@@ -197,13 +466,13 @@ class LineLayout:
             pass
         
         # current patch: add 0 to list in case a paragraph is empty
-        max_ascent = max([word.font.metrics("ascent") 
+        max_ascent = max([word.font.ascent 
                           for word in self.children] + [0])
         baseline = self.y + 1.25 * max_ascent
         for word in self.children:
-            word.y = baseline - word.font.metrics("ascent")
+            word.y = baseline - word.font.ascent
         # same
-        max_descent = max([word.font.metrics("descent") 
+        max_descent = max([word.font.descent 
                            for word in self.children] + [0])
         
         self.height = 1.25 * (max_ascent + max_descent)
@@ -223,6 +492,11 @@ class TextLayout:
         self.parent = parent
         self.previous = previous
         
+        self.x = None
+        self.y = None
+        self.width = None
+        self.height = None
+        
     def __repr__(self):
         return self.word
         
@@ -236,12 +510,12 @@ class TextLayout:
         self.width = self.font.measure(self.word)
         
         if self.previous:
-            space = self.font.measure(" ")
+            space = self.font.space_width
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
             
-        self.height = self.font.metrics("linespace")
+        self.height = self.font.linespace
         
     def should_paint(self):
         return True
@@ -261,6 +535,11 @@ class InputLayout:
         self.parent = parent
         self.previous = previous
         
+        self.x = None
+        self.y = None
+        self.width = None
+        self.height = None
+        
     def layout(self):
         weight = self.node.style["font-weight"]
         style = self.node.style["font-style"]
@@ -271,12 +550,12 @@ class InputLayout:
         self.width = INPUT_WIDTH_PX
         
         if self.previous:
-            space = self.font.measure(" ")
+            space = self.font.space_width
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
             
-        self.height = self.font.metrics("linespace")
+        self.height = self.font.linespace
         
     def should_paint(self):
         return True
@@ -1,138 +1,370 @@
+import functools
+import hashlib
+import heapq
+import re
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
 from htmlparser import Element
 
+# compiled stylesheets kept for reuse by STYLESHEETS
+STYLESHEET_CACHE_SIZE = 64
+
 class CSSParser:
+    """
+    Scans with the regular expressions at the end of this module, which match
+    a whole selector or declaration at a time, instead of stepping through
+    the text a character at a time. Anything it doesn't understand is
+    skipped up to the next ";" inside a block, or past the next "}" outside
+    one, which recovers exactly where raising and catching an error at the
+    offending character used to.
+    """
     def __init__(self, s):
         self.s = s
         self.i = 0
         
     def whitespace(self):
-        while self.i < len(self.s) and self.s[self.i].isspace():
-            self.i += 1
-            
-    def word(self):
-        start = self.i
-        while self.i < len(self.s):
-            if self.s[self.i].isalnum() or self.s[self.i] in "#-.%":
-                self.i += 1
-            else:
-                break
-        if not (self.i > start):
-            raise Exception("Parsing Error")
-        return self.s[start:self.i]
-    
-    def literal(self, literal):
-        if not (self.i < len(self.s) and self.s[self.i] == literal):
-            raise Exception("Parsing Error")
-        self.i += 1
-        
-    def pair(self):
-        prop = self.word()
-        self.whitespace()
-        self.literal(":")
-        self.whitespace()
-        val = self.word()
-        return prop.casefold(), val
-    
-    def ignore_until(self, chars):
-        while self.i < len(self.s):
-            if self.s[self.i] in chars:
-                return self.s[self.i]
-            else:
-                self.i += 1
-        return None
+        self.i = WHITESPACE.match(self.s, self.i).end()
     
     def body(self):
+        s = self.s
         pairs = {}
-        while self.i < len(self.s) and self.s[self.i] != "}":
+        while self.i < len(s) and s[self.i] != "}":
             """ Digital principle or robustness principle - produce maximally
             conformant output but accept even minimally conformant input - 
             different CSS might not render in different browsers, so the 
             principle allows for pages to be displayed in any browser """
-            try:
-                prop, val = self.pair()
-                pairs[prop.casefold()] = val
-                self.whitespace()
-                self.literal(";")
-                self.whitespace()
-            except Exception:
-                why = self.ignore_until([";", "}"])
-                if why == ";":
-                    self.literal(";")
-                    self.whitespace()
-                else:
-                    break
-                
+            match = DECLARATION.match(s, self.i)
+            if match:
+                pairs[match.group(1).casefold()] = match.group(2)
+                self.i = match.end()
+                # a value followed by anything but ";" still counts, and
+                # the rest of the declaration is skipped
+                if match.group(3): continue
+            skip = DECLARATION_END.search(s, self.i)
+            if not skip:
+                self.i = len(s)
+                break
+            if skip.group() == "}":
+                self.i = skip.start()
+                break
+            self.i = skip.end()
         return pairs
     
     def selector(self):
-        out = TagSelector(self.word().casefold())
-        self.whitespace()
-        while self.i < len(self.s) and self.s[self.i] != "{":
-            tag = self.word()
-            descendant = TagSelector(tag.casefold())
-            out = DescendantSelector(out, descendant)
-            self.whitespace()
-        return out
+        match = SELECTOR.match(self.s, self.i)
+        if not match or (match.end() < len(self.s) and
+                         self.s[match.end()] != "{"):
+            raise Exception("Parsing Error")
+        self.i = match.end()
+        return make_selector(match.group(1))
     
     def parse(self):
+        s = self.s
         rules = []
-        while self.i < len(self.s):
-            try:
-                self.whitespace()
-                selector = self.selector()
-                self.literal("{")
+        # rules with the same selector text share one selector object
+        selectors = {}
+        self.whitespace()
+        while self.i < len(s):
+            match = RULE_START.match(s, self.i)
+            if not match:
+                # skip the rest of a rule we can't parse
+                end = s.find("}", self.i)
+                if end == -1: break
+                self.i = end + 1
                 self.whitespace()
-                body = self.body()
-                self.literal("}")
-                rules.append((selector, body))
-            except Exception:
-                why = self.ignore_until(["}"])
-                if why == "}":
-                    self.literal("}")
-                    self.whitespace()
-                else:
-                    break
+                continue
+            selector = selectors.get(match.group(1))
+            if not selector:
+                selector = make_selector(match.group(1))
+                selectors[match.group(1)] = selector
+            self.i = match.end()
+            body = self.body()
+            # a block left open at the end of the text is dropped
+            if self.i >= len(s): break
+            self.i += 1
+            self.whitespace()
+            rules.append((selector, body))
         return rules
 
 
-def style(node, rules):
-    node.style = {}
+def make_selector(text):
+    tags = text.split()
+    out = TagSelector(tags[0].casefold())
+    for tag in tags[1:]:
+        out = DescendantSelector(out, TagSelector(tag.casefold()))
+    return out
+
+
+class StyleSheet:
+    """
+    A parsed stylesheet with its rules already in cascade order: sorted by
+    priority, file order breaking ties. Compiled sheets are shared by every
+    tab that loads the same text, so they are never modified.
+    """
+    def __init__(self, text):
+        self.rules = sorted(CSSParser(text).parse(), key = cascade_priority)
+
+
+class StyleSheetCache:
+    """
+    Compiled stylesheets for the whole process, keyed by URL and a hash of
+    the text, so a stylesheet that several pages or tabs link is parsed and
+    sorted once, and a changed one is compiled afresh. The least recently
+    used sheet is dropped once there are more than max_entries.
+    """
+    def __init__(self, max_entries = STYLESHEET_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url, text):
+        key = (url, hashlib.sha256(text.encode("utf8")).hexdigest())
+        with self.lock:
+            sheet = self.entries.get(key)
+            if sheet:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return sheet
+            self.misses += 1
+        sheet = StyleSheet(text)
+        with self.lock:
+            self.entries[key] = sheet
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last = False)
+        return sheet
+
+
+class Cascade:
+    """
+    The stylesheets a page uses, in document order, merged into one list of
+    rules in cascade order and indexed for style(). Each sheet is sorted
+    already and heapq.merge takes ties from earlier sheets first, so this is
+    the same order as sorting all of their rules together, without sorting
+    again. Built once per page load and used by every render of it.
+    """
+    def __init__(self, sheets):
+        self.sheets = sheets
+        self.rules = list(heapq.merge(*[sheet.rules for sheet in sheets],
+                                      key = cascade_priority))
+        self.index = RuleIndex(self.rules)
+
+
+class RuleIndex:
+    """
+    Buckets the rules by the tag their rightmost selector matches, so each
+    node is only tested against rules that could possibly apply to it
+    instead of the whole stylesheet. Rules with no single tag on the right
+    go in a universal bucket that every node checks. Each bucket keeps the
+    rules' original order, so the cascade is unchanged.
+    """
+    def __init__(self, rules):
+        self.by_tag = {}
+        self.universal = []
+        for i, (selector, body) in enumerate(rules):
+            rule = (i, selector, body)
+            tag = rightmost_tag(selector)
+            if tag is None:
+                self.universal.append(rule)
+            else:
+                self.by_tag.setdefault(tag, []).append(rule)
+        # tag buckets already merged with the universal one, by tag
+        self.merged = {}
+
+    def candidates(self, node):
+        if not isinstance(node, Element): return self.universal
+        if not self.universal: return self.by_tag.get(node.tag, [])
+        if node.tag not in self.merged:
+            # both lists are in rule order, and rule numbers are unique
+            self.merged[node.tag] = list(heapq.merge(
+                self.by_tag.get(node.tag, []), self.universal))
+        return self.merged[node.tag]
+
+
+def rightmost_tag(selector):
+    while isinstance(selector, DescendantSelector):
+        selector = selector.descendant
+    if isinstance(selector, TagSelector):
+        return selector.tag
+    return None
+
+
+class AncestorFilter:
+    """
+    A counting Bloom filter of the tags of every element above the node
+    being styled, kept up to date as style() descends and returns. It can
+    say for certain that a tag is *not* among the ancestors, which lets a
+    descendant selector like "div p a" be rejected without walking up the
+    tree. Two hash positions per tag, counters so tags can be removed.
+    """
+    SIZE = 1 << 12
+
+    def __init__(self, node = None):
+        self.counts = [0] * self.SIZE
+        # seed with the ancestors of a node that isn't the root
+        while node:
+            if isinstance(node, Element):
+                self.push(node.tag)
+            node = node.parent
+
+    def push(self, tag):
+        for i in bloom_positions(tag):
+            self.counts[i] += 1
+
+    def pop(self, tag):
+        for i in bloom_positions(tag):
+            self.counts[i] -= 1
+
+    def may_contain_all(self, positions):
+        counts = self.counts
+        for i in positions:
+            if not counts[i]: return False
+        return True
+
+
+def bloom_positions(tag):
+    h = hash(tag)
+    mask = AncestorFilter.SIZE - 1
+    return (h & mask, (h >> 12) & mask)
+
+
+def style(node, rules, ancestors = None, shared = None):
+    """
+    Styles node and everything below it. The walk keeps its own stack
+    rather than recursing, so deep documents can't overflow Python's; a
+    node's tag is pushed after its children, as a marker to take it back
+    out of the ancestor filter once they have all been styled.
+    """
+    # the rules are indexed once, at the root, and shared by the walk
+    if not isinstance(rules, RuleIndex):
+        rules = RuleIndex(rules)
+    if ancestors is None:
+        ancestors = AncestorFilter(node.parent)
+    if shared is None:
+        shared = {}
+
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, str):
+            ancestors.pop(node)
+            continue
+        style_node(node, rules, ancestors, shared)
+        if node.children:
+            ancestors.push(node.tag)
+            stack.append(node.tag)
+            stack.extend(reversed(node.children))
+
+
+def style_node(node, rules, ancestors, shared):
+    parent_style = node.parent.style if node.parent else None
+    candidates = rules.candidates(node)
+    matched = [rule for rule in candidates
+               if rule[1].matches(node, ancestors)] if candidates else []
+
+    """
+    A node's style depends only on its parent's style, the rules that match
+    it and its own style attribute. A node whose parent style, matched rules
+    and style attribute equal an earlier node's gets that node's style
+    object, which is why computed styles are read-only. Repeated structures
+    like list items, table cells and the text inside them then share one
+    style instead of holding identical copies.
+    """
+    inline = node.attributes.get("style") \
+        if isinstance(node, Element) else None
+    key = (id(parent_style), inline, *[rule[0] for rule in matched])
+    entry = shared.get(key)
+    # the parent style is kept alive by the entry, so ids can't be reused
+    if entry and entry[0] is parent_style:
+        node.style = entry[1]
+    else:
+        node.style = compute_style(parent_style, matched, inline)
+        shared[key] = (parent_style, node.style)
+    node.dirty = False
+    node.children_dirty = False
+
+
+def restyle(node, rules, ancestors = None, shared = None):
+    """
+    Like style(), but only visits the subtrees that mark_dirty() flagged
+    since the last pass. A dirty node is restyled together with everything
+    below it, inheriting from its parent's existing style; clean subtrees
+    keep theirs. A tree that has never been styled is dirty at the root.
+    Returns the roots of the subtrees it restyled, for relayout.
+    """
+    if not isinstance(rules, RuleIndex):
+        rules = RuleIndex(rules)
+    if ancestors is None:
+        ancestors = AncestorFilter(node.parent)
+    if shared is None:
+        shared = {}
+
+    restyled = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, str):
+            ancestors.pop(node)
+        elif node.dirty:
+            style(node, rules, ancestors, shared)
+            restyled.append(node)
+        elif node.children_dirty:
+            node.children_dirty = False
+            ancestors.push(node.tag)
+            stack.append(node.tag)
+            stack.extend(reversed(node.children))
+    return restyled
+
+
+def compute_style(parent_style, matched, inline):
+    style = {}
     """inherited styles come first because they should be overriden by explicit
     rules"""
     for property, default_value in INHERITED_PROPERTIES.items():
-        if node.parent:
-            node.style[property] = node.parent.style[property]
+        if parent_style:
+            style[property] = parent_style[property]
         else:
-            node.style[property] = default_value
+            style[property] = default_value
 
     # stylings that come from CSS file
-    for selector, body in rules:
-        if not selector.matches(node): continue
+    for _, selector, body in matched:
         for property, value in body.items():
-            node.style[property] = value
+            style[property] = value
     
     # stylings that come from HTML "style" tag attrribute
-    if isinstance(node, Element) and "style" in node.attributes:
-        pairs = CSSParser(node.attributes["style"]).body()
+    if inline is not None:
+        pairs = parse_inline_style(inline)
         for property, value in pairs.items():
-            node.style[property] = value
+            style[property] = value
             
     """
     Converts percentage fonts to pixel fonts. This happens after all style
     values have been handled but before we recurse, so that any children
     can assume their parent's font size has been resolved to a pixel value 
     """
-    if node.style["font-size"].endswith("%"):
-        if node.parent:
-            parent_font_size = node.parent.style["font-size"]
+    if style["font-size"].endswith("%"):
+        if parent_style:
+            parent_font_size = parent_style["font-size"]
         else:
             parent_font_size = INHERITED_PROPERTIES["font-size"]
-        node_pct = float(node.style["font-size"][:-1]) / 100
+        node_pct = float(style["font-size"][:-1]) / 100
         parent_px = float(parent_font_size[:-2])
-        node.style["font-size"] = str(node_pct * parent_px) + "px"
-    
-    for child in node.children:
-        style(child, rules)
+        style["font-size"] = str(node_pct * parent_px) + "px"
+    return MappingProxyType(style)
+
+
+# distinct style attribute values whose parsed declarations are kept
+INLINE_STYLE_CACHE_SIZE = 4096
+
+@functools.lru_cache(maxsize = INLINE_STYLE_CACHE_SIZE)
+def parse_inline_style(text):
+    """ Generated pages repeat the same style attributes on many elements,
+    and every render used to parse each of them again. Keyed by the
+    attribute's text, so editing the attribute is what invalidates it; the
+    result is shared by every node and tab with that text, so read-only """
+    return MappingProxyType(CSSParser(text).body())
 
 
 class TagSelector:
@@ -140,7 +372,7 @@ class TagSelector:
         self.tag = tag
         self.priority = 1
         
-    def matches(self, node):
+    def matches(self, node, ancestors = None):
         return isinstance(node, Element) and self.tag == node.tag
 
 
@@ -149,23 +381,54 @@ class DescendantSelector:
         self.ancestor = ancestor
         self.descendant = descendant
         self.priority = ancestor.priority + descendant.priority
+        # every tag left of the last one must be somewhere above the node
+        self.ancestor_positions = [
+            i for tag in selector_tags(ancestor) for i in bloom_positions(tag)]
         
-    def matches(self, node):
+    def matches(self, node, ancestors = None):
         if not self.descendant.matches(node): return False
+        # ancestors, when given, is an AncestorFilter for node
+        if ancestors is not None and \
+            not ancestors.may_contain_all(self.ancestor_positions):
+            return False
         while node.parent:
             if self.ancestor.matches(node.parent): return True
             node = node.parent
         return False
 
 
+def selector_tags(selector):
+    if isinstance(selector, DescendantSelector):
+        return selector_tags(selector.ancestor) + \
+            selector_tags(selector.descendant)
+    return [selector.tag]
+
+
 def cascade_priority(rule):
     selector, body = rule
     return selector.priority
 
 
+# a property name or value: letters, digits and "#-.%"
+WORD = r"(?:[^\W_]|[#.%-])+"
+WHITESPACE = re.compile(r"\s*")
+# one or more tags separated by whitespace
+SELECTOR = re.compile(r"(" + WORD + r"(?:\s+" + WORD + r")*)\s*")
+# a selector and the "{" that opens its block
+RULE_START = re.compile(r"(" + WORD + r"(?:\s+" + WORD + r")*)\s*\{\s*")
+# "property: value", and the ";" after it if there is one
+DECLARATION = re.compile(
+    r"(" + WORD + r")\s*:\s*(" + WORD + r")(?:\s*(;)\s*)?")
+# where a declaration that doesn't parse is abandoned
+DECLARATION_END = re.compile(r";\s*|\}")
+
 INHERITED_PROPERTIES = {
     "font-size": "16px",
     "font-style": "normal",
     "font-weight": "normal",
     "color": "black"
 }
+
+
+# shared by every tab
+STYLESHEETS = StyleSheetCache()
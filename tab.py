@@ -1,21 +1,47 @@
-from htmlparser import HTMLParser, Element, Text
+from htmlparser import HTMLParser, Element, Text, mark_dirty
 from style import *
 from utils import *
 from layout import DocumentLayout
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 import dukpy
 from javascript import JSContext
 
-DEFAULT_STYLE_SHEET = CSSParser(open("browser.css").read()).parse()
+DEFAULT_STYLE_SHEET = StyleSheet(open("browser.css").read())
 # default browser stylesheet
+DEFAULT_CASCADE = Cascade([DEFAULT_STYLE_SHEET])
+
+# at most this many scripts and stylesheets download at the same time
+MAX_CONCURRENT_FETCHES = 8
+FETCHER = ThreadPoolExecutor(max_workers = MAX_CONCURRENT_FETCHES)
+
+def fetch_subresource(base_url, href):
+    # resolving happens on the worker too so a bad link fails like a bad fetch
+    return base_url.resolve(href).request()
+
+# seconds between frames showing a page that is still downloading
+PARTIAL_RENDER_INTERVAL = 0.1
+# pixels laid out beyond the bottom of the screen, so short scrolls don't
+# have to wait for layout
+LAYOUT_MARGIN = 1000
+# pixels of page laid out by each slice of background layout
+LAYOUT_SLICE = 2000
 
 class Tab:
-    def __init__(self, tab_height):
+    def __init__(self, tab_height, on_partial_render = None, schedule = None):
         self.scroll = 0
         self.url = None
         self.tab_height = tab_height
         self.history = []
         self.focus = None
+        self.document = None
+        self.display_list = []
+        # called with the tab after each frame drawn during a page load
+        self.on_partial_render = on_partial_render
+        # runs a function later from the event loop; without one, pages are
+        # laid out in full on every render rather than lazily
+        self.schedule = schedule
         
     def draw(self, canvas, offset):
         for cmd in self.display_list:
@@ -27,9 +53,17 @@ class Tab:
         self.scroll = 0
         self.url = url
         self.history.append(url)
-        body = url.request(payload)
-        # create an HTML tree by parsing the html body
-        self.nodes = HTMLParser(body).parse()
+        # until the page's own stylesheets arrive, partial frames use ours
+        self.cascade = DEFAULT_CASCADE
+        
+        # create an HTML tree by parsing the html body as it arrives
+        parser = HTMLParser("")
+        self.last_partial_render = time.monotonic()
+        def receive(chunk):
+            parser.feed(chunk)
+            self.render_partial(parser)
+        url.request(payload, stream = receive)
+        self.nodes = parser.close()
         
         """
         print("\n")
@@ -41,68 +75,130 @@ class Tab:
         # Downloading javascript scripts
         scripts = [
             node.attributes["src"] for node
-            in tree_to_list(self.nodes, [])
+            in iter_tree(self.nodes)
             if isinstance(node, Element)
             and node.tag == "script"
             and "src" in node.attributes]
         
+        # retrieve stylesheet links from HTML document
+        links = [node.attributes["href"] 
+                 for node in iter_tree(self.nodes)
+                 if isinstance(node, Element)
+                 and node.tag == "link"
+                 and node.attributes.get("rel") == "stylesheet"
+                 and "href" in node.attributes]
+        
+        """
+        Every subresource is requested at once so that the page waits for the
+        slowest download rather than the sum of all of them. The futures are
+        consumed in document order below, so scripts still run, and
+        stylesheets still cascade, in the order they appear in the page.
+        """
+        script_bodies = [FETCHER.submit(fetch_subresource, url, script)
+                         for script in scripts]
+        link_bodies = [FETCHER.submit(fetch_subresource, url, link)
+                       for link in links]
+        
         self.js = JSContext(self)
-        for script in scripts:
-            script_url = url.resolve(script)
+        for script, future in zip(scripts, script_bodies):
             try:
-                body = script_url.request()
+                body = future.result()
             except:
                 continue
             self.js.run(script, body)
             #print("Script returned: ", dukpy.evaljs(body))
         
-        self.rules = DEFAULT_STYLE_SHEET.copy()
-        
         """
         The CSS rule that gets added last overrides the previous if it already
         exists for a certain HTML element. Thus, in this function, CSS rules
         get added later if they have higher priority
         """
-        # retrieve stylesheet links from HTML document
-        # goes after the default style sheet to override its properties
-        # thanks to the way the paint method is implemented
+        # linked stylesheets go after the default style sheet to override its
+        # properties thanks to the way the paint method is implemented
         # try except ignores stylesheets that failed to download but may hide
         # bugs
-        links = [node.attributes["href"] 
-                 for node in tree_to_list(self.nodes, [])
-                 if isinstance(node, Element)
-                 and node.tag == "link"
-                 and node.attributes.get("rel") == "stylesheet"
-                 and "href" in node.attributes]
-        for link in links:
-            style_url = url.resolve(link)
+        sheets = [DEFAULT_STYLE_SHEET]
+        for link, future in zip(links, link_bodies):
             try:
-                body = style_url.request()
+                body = future.result()
             except:
                 print("failed a css stylesheet connection")
                 continue
-            self.rules.extend(CSSParser(body).parse())
+            # parsed and sorted only if no tab has seen this text at this URL
+            sheets.append(STYLESHEETS.get(str(url.resolve(link)), body))
+        self.cascade = Cascade(sheets)
             
+        # the stylesheets are new, so every node needs restyling
+        self.nodes.dirty = True
+        self.render()
+        
+    def render_partial(self, parser):
+        """
+        Shows what has been parsed so far, at most once every
+        PARTIAL_RENDER_INTERVAL seconds, so that the first screenful of a
+        large or slow page appears long before its last byte does
+        """
+        if not self.on_partial_render: return
+        now = time.monotonic()
+        if now - self.last_partial_render < PARTIAL_RENDER_INTERVAL: return
+        if not parser.root(): return
+        self.nodes = parser.root()
+        # nodes parsed since the last frame aren't marked on their ancestors
+        self.nodes.dirty = True
         self.render()
+        self.on_partial_render(self)
+        self.last_partial_render = time.monotonic()
         
     def render(self):
         """
-        Adds CCS to nodes. Python's sorted function keeps the relative order 
-        of things with equal priority, so file order acts as a tie breaker, 
-        as it should.
+        Adds CCS to nodes. The cascade was sorted when the page loaded,
+        keeping the relative order of rules with equal priority, so file
+        order acts as a tie breaker, as it should. Only the subtrees marked
+        dirty since the last render are restyled, and only the blocks
+        around them laid out and painted again.
         """
-        style(self.nodes, sorted(self.rules, key = cascade_priority))
+        restyled = restyle(self.nodes, self.cascade.index)
         
-        # create a root for the layout tree whose child is the root HTML node
+        if self.document and self.document.node is self.nodes and \
+            self.document.done and self.nodes not in restyled:
+            # repaints just the relaid blocks' part of the display list too
+            self.document.relayout(restyled, self.display_list)
+            return
+        # create a root for the layout tree whose child is the root HTML
+        # node
         self.document = DocumentLayout(self.nodes)
-        
-        # create the Layout tree by a recursive mirroring of the HTML tree
-        self.document.layout()
-                
-        # aggregates all the display_lists, containing commands, for each 
-        # layout block
+        if self.schedule:
+            return self.layout_lazily()
+        # create the Layout tree by mirroring the HTML tree, and aggregate
+        # all the display_lists, containing commands, for each layout block
         self.display_list = []
-        paint_tree(self.document, self.display_list)
+        self.document.layout(self.display_list)
+
+    def layout_lazily(self):
+        """
+        Lays out and paints only what the screen shows, plus LAYOUT_MARGIN,
+        so the first screen of a long page takes about as long as that of a
+        short one. The rest is laid out a slice at a time from the event
+        loop, between input events, and scrolling lays out whatever it
+        reaches first. A later render starts a new layout, which stops the
+        old one's slices.
+        """
+        document = self.document
+        document.start()
+        self.display_list = []
+        self.layout_to(self.scroll + self.tab_height + LAYOUT_MARGIN)
+
+        def layout_slice():
+            if self.document is not document or document.done: return
+            # always below the screen, so there is nothing to redraw
+            document.resume(document.y + document.height + LAYOUT_SLICE,
+                            self.display_list)
+            if not document.done: self.schedule(layout_slice)
+        if not document.done: self.schedule(layout_slice)
+
+    def layout_to(self, y):
+        # y in page coordinates, like scroll
+        self.document.resume(y, self.display_list)
   
     def go_back(self):
         if len(self.history) > 1:
@@ -113,7 +209,7 @@ class Tab:
     def submit_form(self, elt):
         self.js.dispatch_event("submit", elt)
         inputs = [
-            node for node in tree_to_list(elt, []) 
+            node for node in iter_tree(elt)
             if isinstance(node, Element)
             and node.tag == "input"
             and "name" in node.attributes]
@@ -140,6 +236,8 @@ class Tab:
     scrolling down doesn't require any information about the key press besides 
     the fact that it happened, scrolldown ignores that event object. """
     def scrolldown(self):
+        self.layout_to(self.scroll + SCROLL_STEP + self.tab_height +
+                       LAYOUT_MARGIN)
         max_y = max(self.document.height + 2 * VSTEP - self.tab_height, 0)
         self.scroll = min(self.scroll + SCROLL_STEP, max_y)
         
@@ -156,20 +254,18 @@ class Tab:
             self.scrollup()
             
     def click(self, x, y):
+        # whatever was focused loses focus, unless the click lands on it again
+        if self.focus:
+            self.focus.is_focused = False
+            mark_dirty(self.focus)
         self.focus = None
         y += self.scroll
         
-        objs = [obj for obj in tree_to_list(self.document, [])
-                if obj.x <= x < obj.x + obj.width
-                and obj.y <= y < obj.y + obj.height]
-        if not objs: return
-        
-        # we go to the end of the list because we want the most specific element
-        # that was clicked
-        elt = objs[-1].node
+        # the most specific element that was clicked
+        obj = self.document.hit_test(x, y)
+        if not obj: return self.render()
+        elt = obj.node
         
-        if self.focus:
-            self.focus.is_focused = False
         while elt:
             if isinstance(elt, Text):
                 pass
@@ -182,6 +278,7 @@ class Tab:
                 self.focus = elt
                 elt.attributes["value"] = ""
                 elt.is_focused = True
+                mark_dirty(elt)
                 return self.render()
             elif elt.tag == "button":
                 self.js.dispatch_event("click", elt)
@@ -196,4 +293,5 @@ class Tab:
         if self.focus:
             self.js.dispatch_event("keydown", self.focus)
             self.focus.attributes["value"] += char
+            mark_dirty(self.focus)
             self.render()
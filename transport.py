@@ -0,0 +1,252 @@
+"""
+Transports stand in for the network under URL.fetch, so that page loads can
+be recorded once and then replayed, byte for byte and with controlled
+latency, on a machine with no network at all:
+
+    transport.use(RecordingTransport("page.jsonl.gz"))
+    ...load pages...
+    transport.current().save()
+
+    transport.use(ReplayTransport("page.jsonl.gz", latency = 0.05))
+"""
+
+import gzip
+import http.server
+import json
+import threading
+import time
+from url import URL
+
+# framing and compression headers describe the wire format, not the body we
+# store, which has already been de-chunked, decompressed and decoded
+WIRE_HEADERS = ["transfer-encoding", "content-encoding", "content-length",
+                "connection", "keep-alive"]
+
+
+def use(transport):
+    URL.transport = transport
+
+def current():
+    return URL.transport
+
+# request headers that change which response a server sends; a 304 only
+# answers the request that carried the matching validators
+CONDITIONAL_HEADERS = ["if-none-match", "if-modified-since"]
+
+def record_key(method, url, payload, headers = None):
+    key = method + " " + url + " " + (payload or "")
+    for header, value in sorted((headers or {}).items()):
+        if header.casefold() in CONDITIONAL_HEADERS:
+            key += "\n" + header.casefold() + ": " + value
+    return key
+
+def load_archive(path):
+    responses = {}
+    with gzip.open(path, "rt", encoding = "utf8") as f:
+        for line in f:
+            record = json.loads(line)
+            key = record_key(record["method"], record["url"],
+                             record["payload"], record["request_headers"])
+            responses.setdefault(key, []).append(record)
+    return responses
+
+def simulated_delay(record, latency, bandwidth, recorded_timing):
+    if recorded_timing:
+        return sum(record["timing"].values())
+    delay = latency
+    if bandwidth:
+        delay += len(record["body"].encode("utf8")) / bandwidth
+    return delay
+
+
+class RecordingTransport:
+    """ fetches from the network as usual and keeps a copy of every request,
+    response and its timing for save() to write out """
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+        self.lock = threading.Lock()
+
+    def fetch(self, url, payload, headers):
+        status, response_headers, content = \
+            url.fetch_network(payload, headers)
+        record = {
+            "method": "POST" if payload else "GET",
+            "url": str(url),
+            "payload": payload,
+            "request_headers": headers,
+            "status": status,
+            "headers": {header: value
+                        for header, value in response_headers.items()
+                        if header not in WIRE_HEADERS},
+            "body": content,
+            "timing": url.timing,
+        }
+        with self.lock:
+            self.records.append(record)
+        return status, response_headers, content
+
+    def save(self):
+        with self.lock:
+            with gzip.open(self.path, "wt", encoding = "utf8") as f:
+                for record in self.records:
+                    f.write(json.dumps(record) + "\n")
+
+
+class ReplayTransport:
+    """
+    Serves responses from an archive without touching a socket. A URL that
+    was fetched several times is answered with its recordings in order, the
+    last one repeating; rewind() starts every URL from its first recording
+    again. Conditional requests are told apart by their validators, so a
+    cold cache is always answered with the full response and never with a
+    304 recorded for a warm one. Each response is delayed by latency seconds
+    plus its size over bandwidth bytes per second, or by the time it
+    originally took if recorded_timing is set.
+    """
+    def __init__(self, path, latency = 0, bandwidth = None,
+                 recorded_timing = False):
+        self.responses = load_archive(path)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.recorded_timing = recorded_timing
+        self.served = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, method, url, payload, headers = None):
+        key = record_key(method, url, payload, headers)
+        records = self.responses.get(key)
+        if not records:
+            # validators we never recorded can still be sent a full response
+            key = record_key(method, url, payload)
+            records = self.responses.get(key)
+        if not records: return None
+        with self.lock:
+            i = self.served.get(key, 0)
+            self.served[key] = i + 1
+        return records[min(i, len(records) - 1)]
+
+    def rewind(self):
+        with self.lock:
+            self.served = {}
+
+    def fetch(self, url, payload, headers):
+        method = "POST" if payload else "GET"
+        record = self.lookup(method, str(url), payload, headers)
+        if not record:
+            # fails the same way an unreachable server would
+            raise ConnectionError(
+                "not in archive: " + method + " " + str(url))
+        delay = simulated_delay(record, self.latency, self.bandwidth,
+                                self.recorded_timing)
+        time.sleep(delay)
+        url.timing = {"dns": 0, "connect": 0, "tls": 0, "ttfb": delay,
+                      "body": 0}
+        return record["status"], dict(record["headers"]), record["body"]
+
+
+class ReplayServer:
+    """
+    Serves an archive over HTTP on a loopback port, so that replayed loads
+    still exercise our own socket, pooling and response-parsing code. The
+    URL originally requested travels in an X-Original-URL header; latency
+    is applied before the response and bandwidth while writing its body.
+    """
+    def __init__(self, path, latency = 0, bandwidth = None,
+                 recorded_timing = False):
+        self.replay = ReplayTransport(path)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.recorded_timing = recorded_timing
+
+        self.server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target = self.server.serve_forever,
+                                       daemon = True)
+        self.thread.start()
+
+    def handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # keep-alive, like the servers we recorded
+            protocol_version = "HTTP/1.1"
+            # headers and body go out as two writes; with Nagle's algorithm
+            # the body would wait for the client's delayed ACK, adding
+            # about 40 ms to every response on a kept-alive socket
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self.replay(None)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                self.replay(self.rfile.read(length).decode("utf8"))
+
+            def replay(self, payload):
+                url = self.headers.get("X-Original-URL", "")
+                record = server.replay.lookup(self.command, url, payload,
+                                              dict(self.headers.items()))
+                if not record:
+                    self.send_error(502, "not in archive")
+                    return
+                body = record["body"].encode("utf8")
+                if server.recorded_timing:
+                    time.sleep(record["timing"]["ttfb"])
+                else:
+                    time.sleep(server.latency)
+                self.send_response_only(int(record["status"]))
+                for header, value in record["headers"].items():
+                    if header == "content-type":
+                        # the body is re-encoded as UTF-8 below
+                        value = value.split(";")[0] + "; charset=utf-8"
+                    self.send_header(header, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                server.write_body(self.wfile, body, record)
+
+        return Handler
+
+    def write_body(self, wfile, body, record):
+        if self.recorded_timing:
+            bandwidth = len(body) / record["timing"]["body"] \
+                if record["timing"]["body"] else None
+        else:
+            bandwidth = self.bandwidth
+        if not bandwidth:
+            wfile.write(body)
+            return
+        step = 16 * 1024
+        for i in range(0, len(body), step):
+            wfile.write(body[i:i + step])
+            time.sleep(len(body[i:i + step]) / bandwidth)
+
+    def rewind(self):
+        self.replay.rewind()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class LoopbackTransport:
+    """ sends every request, through the normal network code, to a
+    ReplayServer instead of the host in the URL """
+    def __init__(self, server):
+        self.server = server
+
+    def rewind(self):
+        self.server.rewind()
+
+    def fetch(self, url, payload, headers):
+        local = URL("http://127.0.0.1:" + str(self.server.port) + url.path)
+        headers = dict(headers)
+        headers["X-Original-URL"] = str(url)
+        response = local.fetch_network(payload, headers)
+        url.timing = local.timing
+        return response
@@ -1,8 +1,13 @@
-import socket
-# encrypted HTTPS connections
-import ssl
+import codecs
+import time
+import zlib
+from cache import CACHE
+from connection import POOL
 
 class URL:
+    # set by transport.use(); None means talk to the network
+    transport = None
+
     def __init__(self, url):
         self.scheme, url = url.split("://", 1)
         assert self.scheme in ["http", "https"]
@@ -21,6 +26,8 @@ class URL:
             self.port = int(port)
         
         self.path = "/" + url
+        # seconds spent in each phase of the last network fetch of this URL
+        self.timing = None
         
     def __repr__(self):
         return f"{self.scheme}://{self.host}:{str(self.port)}{self.path}"
@@ -49,26 +56,68 @@ class URL:
             return  URL(self.scheme + "://" + self.host + \
                 ":" + str(self.port) + url)
         
-    def request(self, payload = None):
-        # create socket
-        s = socket.socket(
-            family = socket.AF_INET,
-            type = socket.SOCK_STREAM,
-            # computer can send arbitrary amounts of data
-            proto = socket.IPPROTO_TCP,
-        )
-        
-        # connect socket to host
-        s.connect((self.host, self.port))
-        # requires host and port - port depends on protocol used
-        if self.scheme == "https":
-            ctx = ssl.create_default_context()
-            s = ctx.wrap_socket(s, server_hostname = self.host)
-        
+    def request(self, payload = None, stream = None):
+        """ stream, if given, is called with each piece of the decoded body
+        as it arrives, before the whole body is returned """
+        streamed = [False]
+        def receive(text):
+            streamed[0] = True
+            stream(text)
+        receiver = receive if stream else None
+
+        # POSTs have side effects, so they never go through the cache
+        if payload:
+            status, headers, content = self.fetch(payload, None, receiver)
+        else:
+            content = CACHE.request(str(self),
+                lambda headers: self.fetch(None, headers, receiver))
+        # cache hits and transports hand over the body in one piece
+        if stream and not streamed[0] and content:
+            stream(content)
+        return content
+
+    def fetch(self, payload = None, headers = None, stream = None):
+        # a recording or replaying transport can stand in for the network,
+        # see transport.py
+        if URL.transport:
+            return URL.transport.fetch(self, payload, headers or {})
+        return self.fetch_network(payload, headers, stream)
+
+    def fetch_network(self, payload = None, headers = None, stream = None):
+        while True:
+            conn = POOL.acquire(self.scheme, self.host, self.port)
+            try:
+                status, response_headers, content, reuse = \
+                    self.exchange(conn, payload, headers or {}, stream)
+            except BaseException as e:
+                """ whatever went wrong, e.g. a corrupt gzip body or an error
+                in the stream callback, the rest of the response may still be
+                in the socket, so it can't be reused. Not giving the slot
+                back would leave later requests to this host waiting on it
+                forever """
+                POOL.release(conn, reuse = False)
+                # the server may have closed an idle keep-alive socket just
+                # before we used it; that is worth one retry on a new socket,
+                # as long as nothing of the response had arrived
+                if isinstance(e, (OSError, ValueError)) and conn.reused and \
+                    not conn.answered:
+                    continue
+                raise
+            POOL.release(conn, reuse)
+            return status, response_headers, content
+
+    def exchange(self, conn, payload, headers, stream):
         # request data from host
         method = "POST" if payload else "GET"
-        request = "{} {} HTTP/1.0\r\n".format(method, self.path)
+        request = "{} {} HTTP/1.1\r\n".format(method, self.path)
         request += "Host: {}\r\n".format(self.host)
+        # ask the server to leave the socket open for our next request
+        request += "Connection: keep-alive\r\n"
+        # compressed bodies are decompressed as they stream in
+        request += "Accept-Encoding: gzip, deflate\r\n"
+        # e.g. the conditional headers the cache uses to revalidate
+        for header, value in headers.items():
+            request += "{}: {}\r\n".format(header, value)
         # If it's a POST request the Content-Length header is mandatory
         if payload:
             # Content-Length is payload in bytes
@@ -76,29 +125,175 @@ class URL:
             request += "Content-Length: {}\r\n".format(length)
         request += "\r\n"
         if payload: request += payload
-        s.send(request.encode("utf8"))
+        conn.answered = False
+        sent = time.monotonic()
+        conn.socket.sendall(request.encode("utf8"))
         
         # get server response
-        response = s.makefile("r", encoding = "utf8", newline = "\r\n")
-        """ the makefile method abstracts the loop that collects bytes as they 
-        arrive from the server """
-        statusline = response.readline()
+        response = conn.file
+        statusline = response.readline().decode("latin-1")
+        first_byte = time.monotonic()
+        conn.answered = bool(statusline)
         version, status, explanation = statusline.split(" ", 2)
         
         response_headers = {}
         while True:
-            line = response.readline()
-            if line == "\r\n":
+            line = response.readline().decode("latin-1")
+            if line in ["\r\n", "\n", ""]:
                 break
             header, value = line.split(":", 1)
             response_headers[header.casefold()] = value.strip()
             """ headers are case-sensitive - this normalizes them on our side 
             if they come from server with capitals - and whitespace is 
             insignificant in HTTP header values """
-        assert "transfer-encoding" not in response_headers
-        assert "content-encoding" not in response_headers
-        # indicates data is being sent in an unusual way
-        
-        content = response.read()
-        s.close()
-        return content
+
+        connection = response_headers.get("connection", "").casefold()
+        if version == "HTTP/1.0":
+            reuse = connection == "keep-alive"
+        else:
+            reuse = connection != "close"
+
+        encoding = response_headers.get("content-encoding", "identity")
+        encoding = encoding.casefold()
+        charset = get_charset(response_headers.get("content-type", ""))
+
+        """ on a kept-alive socket the server can't signal the end of the body
+        by closing the connection, so it either tells us the length up front
+        or sends the body in length-prefixed chunks """
+        body = bytearray()
+        in_place = False
+        if response_headers.get("transfer-encoding", "").casefold() == \
+            "chunked":
+            chunks = read_chunked(response)
+        elif "content-length" in response_headers:
+            length = int(response_headers["content-length"])
+            if encoding == "identity":
+                # the common case: the socket fills the final buffer directly
+                body = bytearray(length)
+                chunks = read_blocks_into(response, memoryview(body))
+                in_place = True
+            else:
+                chunks = read_length(response, length)
+        elif method == "HEAD" or status in ["204", "304"]:
+            chunks = iter([])
+        else:
+            # old-style response delimited by closing the socket
+            chunks = read_until_close(response)
+            reuse = False
+
+        """ each piece is decompressed as soon as it arrives, so the whole
+        compressed body is never held in memory. The bytes are decoded to
+        text exactly once, at the end, unless the caller wants the text as
+        it streams in """
+        if stream:
+            decoder = codecs.getincrementaldecoder(charset)("replace")
+            text = []
+            for chunk in decompress(chunks, encoding):
+                text.append(decoder.decode(chunk))
+                if text[-1]: stream(text[-1])
+            text.append(decoder.decode(b"", final = True))
+            if text[-1]: stream(text[-1])
+            content = "".join(text)
+        else:
+            for chunk in decompress(chunks, encoding):
+                if not in_place: body += chunk
+            content = body.decode(charset, "replace")
+
+        # a reused socket skipped the DNS lookup, connect and TLS handshake
+        setup = {"dns": 0, "connect": 0, "tls": 0} if conn.reused \
+            else conn.timing
+        self.timing = dict(setup, ttfb = first_byte - sent,
+                           body = time.monotonic() - first_byte)
+        return status, response_headers, content, reuse
+
+
+# read the socket in pieces of this many bytes
+BLOCK_SIZE = 64 * 1024
+
+def read_into(response, view):
+    while view:
+        n = response.readinto(view)
+        if not n:
+            raise ConnectionError("connection closed mid-body")
+        view = view[n:]
+
+def read_blocks_into(response, view):
+    """ fills view from the socket a block at a time, yielding each block
+    as soon as it is filled """
+    for start in range(0, len(view), BLOCK_SIZE):
+        block = view[start:start + BLOCK_SIZE]
+        read_into(response, block)
+        yield block
+
+def read_length(response, length, buffer = None):
+    """ yields views of one reusable buffer, so each block must be consumed
+    before asking for the next """
+    if buffer is None:
+        buffer = memoryview(bytearray(min(length, BLOCK_SIZE)))
+    while length > 0:
+        block = buffer[:min(length, len(buffer))]
+        read_into(response, block)
+        length -= len(block)
+        yield block
+
+def read_chunked(response):
+    buffer = memoryview(bytearray(BLOCK_SIZE))
+    while True:
+        size_line = response.readline()
+        # chunk extensions after ";" carry nothing we need
+        size = int(size_line.split(b";", 1)[0].strip(), 16)
+        if size == 0: break
+        yield from read_length(response, size, buffer)
+        # CRLF closing the chunk
+        response.readline()
+    # skip any trailer headers up to the final blank line
+    while response.readline() not in [b"\r\n", b"\n", b""]:
+        pass
+
+def read_until_close(response):
+    buffer = memoryview(bytearray(BLOCK_SIZE))
+    while True:
+        n = response.readinto1(buffer)
+        if not n: break
+        yield buffer[:n]
+
+def get_charset(content_type):
+    # e.g. "text/html; charset=ISO-8859-1"; HTTP's default used to be
+    # latin-1, but in practice pages without one are UTF-8
+    for param in content_type.split(";")[1:]:
+        if "=" not in param: continue
+        name, value = param.split("=", 1)
+        if name.strip().casefold() == "charset":
+            charset = value.strip().strip('"\'')
+            try:
+                return codecs.lookup(charset).name
+            except LookupError:
+                break
+    return "utf8"
+
+def decompress(chunks, encoding):
+    if encoding == "identity":
+        yield from chunks
+        return
+    if encoding not in ["gzip", "x-gzip", "deflate"]:
+        raise ValueError("unsupported content-encoding " + encoding)
+    decompressor = None
+    for chunk in chunks:
+        if not chunk: continue
+        if decompressor is None:
+            decompressor = zlib.decompressobj(deflate_wbits(encoding, chunk))
+        yield decompressor.decompress(chunk)
+    if decompressor:
+        yield decompressor.flush()
+
+def deflate_wbits(encoding, first_chunk):
+    if encoding != "deflate":
+        # gzip header and trailer around the deflate stream
+        return 16 + zlib.MAX_WBITS
+    """ "deflate" is meant to be a zlib stream, but some servers send raw
+    deflate data; a zlib header has compression method 8 in its low bits
+    and makes the first two bytes a multiple of 31 """
+    if len(first_chunk) >= 2 and first_chunk[0] & 0x0f == 8 and \
+        (first_chunk[0] * 256 + first_chunk[1]) % 31 == 0:
+        return zlib.MAX_WBITS
+    return -zlib.MAX_WBITS
@@ -1,36 +1,111 @@
-import tkinter.font
+import functools
+from fontbackend import TkFontBackend
 
 WIDTH, HEIGHT = 800, 600
 HSTEP, VSTEP = 13, 18
 SCROLL_STEP = 100
 FONTS = {}
+# (font key, text) pairs whose measured width is kept
+MEASURE_CACHE_SIZE = 64 * 1024
+
+# makes the fonts getfont returns, see fontbackend.py
+FONT_BACKEND = TkFontBackend()
 
 def getfont(size, weight, style):
     key = (size, weight, style)
     if key not in FONTS:
-        font = tkinter.font.Font(
-            size = size,
-            weight = weight,
-            slant = style
-        )
-        label = tkinter.Label(font = font)
-        # what does this do?
-        FONTS[key] = (font, label)
+        font, label = FONT_BACKEND.create(size, weight, style)
+        FONTS[key] = (CachedFont(key, font), label)
     return FONTS[key][0]
 
+def use_font_backend(backend):
+    # fonts and widths from the previous backend would no longer match
+    global FONT_BACKEND
+    FONT_BACKEND = backend
+    FONTS.clear()
+    measure_text.cache_clear()
+
+
+class CachedFont:
+    """
+    A backend font whose measurements are remembered. With Tk every
+    measure() or metrics() call is a round trip into Tcl, and layout asks
+    for the same word's width several times per render and for a font's
+    metrics once per word, so metrics are fetched once when the font is
+    made and widths go through measure_text's cache. Anywhere Tk expects a
+    font, this works too, since Tk only needs its name.
+    """
+    def __init__(self, key, font):
+        self.key = key
+        self.font = font
+        self.all_metrics = font.metrics()
+        self.ascent = self.all_metrics["ascent"]
+        self.descent = self.all_metrics["descent"]
+        self.linespace = self.all_metrics["linespace"]
+        self.space_width = font.measure(" ")
+
+    def measure(self, text):
+        return measure_text(self.key, text)
+
+    def metrics(self, option = None):
+        # the same answers as tkinter's Font.metrics
+        if option is None: return dict(self.all_metrics)
+        return self.all_metrics[option]
+
+    def __str__(self):
+        return str(self.font)
+
+
+@functools.lru_cache(maxsize = MEASURE_CACHE_SIZE)
+def measure_text(key, text):
+    return FONTS[key][0].font.measure(text)
+
+def font_cache_stats():
+    info = measure_text.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "hit_rate": info.hits / lookups if lookups else 0.0,
+        "entries": info.currsize,
+        "fonts": len(FONTS),
+    }
+
+"""
+The tree walks below keep their own stack of nodes still to visit instead of
+recursing, so a document nested tens of thousands of levels deep can't hit
+Python's recursion limit. Children are pushed in reverse so they come off
+the stack in document order, which is the order the recursive versions
+visited them in.
+"""
+
 def tree_to_list(tree, list):
-    list.append(tree)
-    for child in tree.children:
-        tree_to_list(child, list)
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        list.append(node)
+        if node.children:
+            stack.extend(reversed(node.children))
     return list
 
+def iter_tree(tree):
+    # yields the same nodes as tree_to_list, without building the list
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        yield node
+        if node.children:
+            stack.extend(reversed(node.children))
+
 def print_tree(node, indent = 0):
-    print(" " * indent, node)
-    for child in node.children:
-        print_tree(child, indent + 2)
+    stack = [(node, indent)]
+    while stack:
+        node, indent = stack.pop()
+        print(" " * indent, node)
+        for child in reversed(node.children):
+            stack.append((child, indent + 2))
         
 def paint_tree(layout_object, display_list):
-    if layout_object.should_paint():
-        display_list.extend(layout_object.paint())
-    for child in layout_object.children:
-        paint_tree(child, display_list)
\ No newline at end of file
+    for layout_object in iter_tree(layout_object):
+        if layout_object.should_paint():
+            display_list.extend(layout_object.paint())